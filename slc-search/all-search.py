@@ -14,14 +14,14 @@ import subprocess
 from Bio import SeqIO
 from io import StringIO
 
-from historytable import Database, HistoryTable
+from historytable import open_database, HistoryTable
 
 user = 'all-search.py'
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 tcdb_families = HistoryTable('tcdb_families', DB)
 tcdb_members = HistoryTable('tcdb_members', DB)
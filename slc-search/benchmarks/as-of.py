@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# vim: ai
+
+# measures HistoryTable.as_of() on a synthetic history table, with and
+# without the indexes of HistoryTable.index_definitions()
+#
+#   python as-of.py [n_rows [n_records [n_points]]]
+#
+# the table bench_as_of_history is created in the database and dropped
+# afterwards
+
+import sys
+import time
+import random
+import logging
+
+sys.path.append('../pylib')
+
+from historytable import Database, HistoryTable
+
+logging.basicConfig(level=logging.INFO)
+
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+n_records = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+n_points = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+DB = Database()
+
+name = 'bench_as_of'
+
+DB.query('DROP TABLE IF EXISTS `{}_history`;'.format(name)).close()
+DB.query('CREATE TABLE `{}_history` ('
+         '`id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+         '`record_id` INT NOT NULL, '
+         '`value` VARCHAR(32), '
+         '`manual` TINYINT NOT NULL DEFAULT 0, '
+         '`deleted` TINYINT NOT NULL DEFAULT 0, '
+         '`timestamp` TIMESTAMP NOT NULL, '
+         '`user` VARCHAR(64), '
+         '`comments` TEXT);'.format(name)).close()
+
+random.seed(1)
+logging.info('inserting {:d} rows for {:d} records'.format(n_rows, n_records))
+# one version per minute
+start_time = 1500000000
+cur = DB.conn.cursor()
+chunk = []
+for i in range(n_rows):
+    chunk.append((random.randint(1, n_records),
+                  random.choice(['A', 'a', 'B', None]),
+                  int(random.random() < 0.05),
+                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.gmtime(start_time + 60*i))))
+    if (len(chunk) == 10000) or (i == n_rows-1):
+        cur.executemany('INSERT INTO `{}_history` (`record_id`, `value`, '
+                        '`deleted`, `timestamp`) VALUES (%s, %s, %s, %s)'.format(
+                            name), chunk)
+        chunk = []
+cur.close()
+DB.commit()
+
+history = HistoryTable(name, DB)
+ids = sorted(random.sample(range(1, n_rows+1), min(n_points, n_rows)))
+
+def run(label):
+    for kind in ('id', 'timestamp'):
+        start = time.time()
+        n = 0
+        for x in ids:
+            if kind == 'id': point = x
+            else: point = time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.gmtime(start_time + 60*(x-1)))
+            cur = DB.query(history.as_of(point))
+            n += len(cur.fetchall())
+            cur.close()
+        elapsed = time.time() - start
+        print('{:<16s} {:<10s} {:d} queries in {:.3f} s ({:.1f} ms per '
+              'query, {:d} rows)'.format(label, kind, len(ids), elapsed,
+                                         1000.0*elapsed/len(ids), n))
+
+run('without indexes')
+DB.direct = True
+history.print_index_sql()
+DB.flush()
+run('with indexes')
+
+DB.query('DROP TABLE `{}_history`;'.format(name)).close()
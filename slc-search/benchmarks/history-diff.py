@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# vim: ai
+
+# compares the two SQL backends of HistoryTable.get_field_changes() (correlated
+# MAX(id) subquery vs. LAG() window function) on a synthetic history table
+#
+#   python history-diff.py [n_rows [n_records [n_lookups]]]
+#
+# the table bench_history_diff_history is created in the database and dropped
+# afterwards
+
+import sys
+import time
+import random
+import logging
+
+sys.path.append('../pylib')
+
+from historytable import Database, HistoryTable
+
+logging.basicConfig(level=logging.INFO)
+
+n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+n_records = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+n_lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+DB = Database()
+
+name = 'bench_history_diff'
+
+DB.query('DROP TABLE IF EXISTS `{}_history`;'.format(name)).close()
+DB.query('CREATE TABLE `{}_history` ('
+         '`id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY, '
+         '`record_id` INT NOT NULL, '
+         '`value` VARCHAR(32), '
+         '`manual` TINYINT NOT NULL DEFAULT 0, '
+         '`deleted` TINYINT NOT NULL DEFAULT 0, '
+         '`timestamp` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+         '`user` VARCHAR(64), '
+         '`comments` TEXT, '
+         'KEY `record_id_id` (`record_id`, `id`));'.format(name)).close()
+
+random.seed(1)
+logging.info('inserting {:d} rows for {:d} records'.format(n_rows, n_records))
+cur = DB.conn.cursor()
+chunk = []
+for i in range(n_rows):
+    chunk.append((random.randint(1, n_records),
+                  random.choice(['A', 'a', 'B', None]),
+                  int(random.random() < 0.1),
+                  int(random.random() < 0.05)))
+    if (len(chunk) == 10000) or (i == n_rows-1):
+        cur.executemany('INSERT INTO `{}_history` (`record_id`, `value`, '
+                        '`manual`, `deleted`) VALUES (%s, %s, %s, %s)'.format(
+                            name), chunk)
+        chunk = []
+cur.close()
+DB.commit()
+
+history = HistoryTable(name, DB)
+record_ids = random.sample(range(1, n_records+1), min(n_lookups, n_records))
+
+results = dict()
+for engine in ('subquery', 'window'):
+    history.diff_engine = engine
+    start = time.time()
+    results[engine] = [history.get_field_changes('value', {'record_id': x})
+                       for x in record_ids]
+    elapsed = time.time() - start
+    print('{:<10s} {:d} lookups in {:.3f} s ({:.2f} ms per lookup)'.format(
+        engine, len(record_ids), elapsed, 1000.0*elapsed/len(record_ids)))
+
+if results['subquery'] != results['window']:
+    logging.error('the two backends returned different results')
+else:
+    logging.info('results of both backends are identical')
+
+DB.query('DROP TABLE `{}_history`;'.format(name)).close()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# vim: ai
+
+# recompresses UniProt files as BGZF and indexes their entries by accession,
+# so sync-uniprot-info.py can read the entries it needs without decompressing
+# the whole file, see pylib/bgzf.py
+#
+#   python bgzip-uniprot.py uniprot-all.fasta uniprot*.txt.gz
+#
+# <name>.txt(.gz) becomes <name>.txt.bgz, <name>.fasta(.gz) <name>.fasta.bgz,
+# each with an index <name>.<txt|fasta>.bgz.accidx
+
+import sys
+import logging
+import gzip
+
+sys.path.append('./pylib')
+
+from bgzf import BgzfWriter
+from fastaindex import FastaIndex
+from uniprot import UniProtIndex
+
+#logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+for fn in sys.argv[1:]:
+    name = fn[:-3] if fn.endswith('.gz') else fn
+    if name.endswith('.txt'): index_class = UniProtIndex
+    elif name.endswith('.fasta'): index_class = FastaIndex
+    else:
+        logging.warning('{} is neither a TXT nor a FASTA file, '
+                        'skipping'.format(fn))
+        continue
+    bgz_fn = name + '.bgz'
+
+    logging.info('compressing {} to {}'.format(fn, bgz_fn))
+    if fn.endswith('.gz'): f = gzip.open(fn, 'rb')
+    else: f = open(fn, 'rb')
+    out = BgzfWriter(bgz_fn)
+    while True:
+        data = f.read(1 << 22)
+        if not data: break
+        out.write(data)
+    out.close()
+    f.close()
+
+    index_class(bgz_fn).close()
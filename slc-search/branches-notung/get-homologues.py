@@ -14,14 +14,14 @@ import subprocess
 import itertools
 import re
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table
 
 import hashlib
 
 logging.basicConfig(level=logging.DEBUG)
 #logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 slc_like = HistoryTable('slc_like', DB)
 slc_like_clusters = Table('slc_like_clusters', DB)
@@ -13,7 +13,8 @@ import os.path
 import subprocess
 import itertools
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table
+from rowcache import RowCache
 
 from Bio import AlignIO, Phylo
 from Bio.Align import MultipleSeqAlignment
@@ -25,7 +26,7 @@ import hashlib
 logging.basicConfig(level=logging.DEBUG)
 #logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 hmm_hits = sql.Table('hmm_hits')
 uniprot_proteins = HistoryTable('uniprot_proteins', DB)
@@ -93,12 +94,13 @@ with open('{}/{}_phyml_tree.txt'.format(sms_dir, phylip_fn), 'rt',
 descriptions = [x for x in open(fasta_fn, 'rt', encoding='utf-8') if
                 x.startswith('>')]
 slc_names = dict()
+# the trees of all families need the same proteins, see SLC_ROW_CACHE
+cache = RowCache(uniprot_proteins, 'accession')
+proteins = cache.get_many([x.id for x in msa_old])
+cache.close()
 for i in range(len(msa_old)):
     uid = msa_old[i].id
-    q = uniprot_proteins.select(where=(uniprot_proteins.accession == uid))
-    cur = DB.query(q, dictionary=True)
-    p = cur.fetchone()
-    cur.close()
+    p = proteins[uid]
 
     if p is not None:
         if p['symbol'] is not None: slc_name = p['symbol'] + tax2tag.get(p['tax_id'], '_other')
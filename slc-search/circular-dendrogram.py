@@ -16,14 +16,14 @@ import sql.aggregate
 
 sys.path.append('./pylib')
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table
 
 user = 'circular-dendrogram.py'
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 sl = Table('pdb_hits', DB)
 slc_like = HistoryTable('slc_like', DB)
@@ -13,19 +13,20 @@ import re
 import os.path
 import networkx as nx
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table, Parameter, \
+        AsyncDatabase
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 hmm_hits = sql.Table('hmm_hits')
 # we will use print_insert_sql, so we use Table, not sql.Table
 hmm_hits_clusters = Table('hmm_hits_clusters', DB)
 hmm_hits_cluster_constraints = sql.Table('hmm_hits_cluster_constraints')
-uniprot_proteins = HistoryTable('uniprot_proteins', DB)
-uniprot_dbrefs = HistoryTable('uniprot_dbrefs', DB)
+uniprot_proteins = HistoryTable('uniprot_proteins', DB, snapshot=True)
+uniprot_dbrefs = HistoryTable('uniprot_dbrefs', DB, snapshot=True)
 
 q = hmm_hits.join(
     uniprot_proteins,
@@ -50,21 +51,22 @@ clusters = dict()
 uniprot_fingerprints = dict()
 uniprot_tax_ids = dict()
 sp_accessions = set()
+q_dbrefs = DB.prepare(uniprot_dbrefs.select(
+    where=(uniprot_dbrefs.accession == Parameter('accession'))))
+# the dbrefs of the proteins are looked up concurrently, a chunk at a time
+ADB = AsyncDatabase(DB)
+all_dbrefs = ADB.imap(q_dbrefs, (x['accession'] for x in proteins),
+                      dictionary=True)
 
 # here we go through each sequence and create a fingerprint for it based on
 # uniprot annotations
 # we also collect all sequences that belong to a specific annotation
-for protein in proteins:
+for protein, dbrefs in zip(proteins, all_dbrefs):
     fp = dict()
 
     if protein['symbol'] is not None:
         fp['Gene Symbol'] = protein['symbol']
     if protein['reviewed'] == 1: sp_accessions.add(protein['accession'])
-    q = uniprot_dbrefs.select(
-        where=(uniprot_dbrefs.accession == protein['accession']))
-    cur = DB.query(q, dictionary=True)
-    dbrefs = cur.fetchall()
-    cur.close()
 
     for dbref in dbrefs:
         if dbref['db'] not in fp:
@@ -89,6 +91,8 @@ for protein in proteins:
             clusters[(protein_id, protein['tax_id'])] = []
         clusters[(protein_id, protein['tax_id'])].append(protein['accession'])
 
+ADB.close()
+
 # we add each sequence as a node to the graph
 G = nx.Graph()
 for protein in proteins:
@@ -322,7 +326,7 @@ str_protein = lambda p: '{:<20s} ({}) {:<15s} {:>5d} "{}"'.format(
     p['symbol'], uniprot_tax_ids[p['accession']], p['name'])
 
 cluster_id = 1
-print('TRUNCATE TABLE {!s};'.format(hmm_hits_clusters))
+hmm_hits_clusters.print_truncate_sql()
 
 for c in nx.connected_components(G):
     reps = set()
@@ -362,3 +366,6 @@ for c in nx.connected_components(G):
 for acc1, acc2 in never_join - never_join_hit:
     logging.info('split constraint never used: {} {}'.format(acc1, acc2))
 
+
+# apply queued writes (direct mode only)
+DB.flush()
@@ -16,7 +16,8 @@ import numpy as np
 import scipy
 import scipy.cluster.hierarchy as hac
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table, Parameter
+from rowcache import RowCache
 
 from hashlib import sha256
 
@@ -25,17 +26,17 @@ user = 'cluster-slc-like.py'
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 hmm_hits = sql.Table('hmm_hits')
 # we will use print_insert_sql, so we use Table, not sql.Table
-slc_like = HistoryTable('slc_like', DB)
+slc_like = HistoryTable('slc_like', DB, snapshot=True)
 slc_like_cluster_constraints = HistoryTable('slc_like_cluster_constraints', DB)
 slc_like_clusters_linkage = Table('slc_like_clusters_linkage', DB)
 slc_like_clusters = Table('slc_like_clusters', DB)
 slc_families_defining_members = \
         HistoryTable('slc_families_defining_members', DB)
-uniprot_proteins = HistoryTable('uniprot_proteins', DB)
+uniprot_proteins = HistoryTable('uniprot_proteins', DB, snapshot=True)
 
 q = slc_like.select(
     slc_like.accession,
@@ -49,15 +50,11 @@ logging.info('read {:d} proteins'.format(len(all_accessions)))
 
 # read uniprot gene symbols, we need these later
 gene_symbols = dict()
-for acc in all_accessions:
-    q = uniprot_proteins.select(
-        uniprot_proteins.symbol,
-        where=(uniprot_proteins.accession == acc))
-    cur = DB.query(q)
-    rows = cur.fetchall()
-    cur.close()
-    if (len(rows) > 0) and (rows[0][0] is not None):
-        gene_symbols[acc] = rows[0][0]
+proteins = RowCache(uniprot_proteins, 'accession')
+for acc, protein in proteins.get_many(all_accessions).items():
+    if (protein is not None) and (protein['symbol'] is not None):
+        gene_symbols[acc] = protein['symbol']
+proteins.close()
 logging.info('found gene symbols for {:d} '
              'accessions'.format(len(gene_symbols)))
 
@@ -65,12 +62,13 @@ logging.info('found gene symbols for {:d} '
 # (acc, pfam_id) is unique in hmm_hits (see upload-hmm-hits.py)
 slc_hits = dict()
 all_pfams = set()
+q = DB.prepare(hmm_hits.select(
+    hmm_hits.pfam_id,
+    hmm_hits.bit_score,
+    where=((hmm_hits.accession == Parameter('accession')) &
+           (hmm_hits.bit_score > 25))))
 for acc in all_accessions:
-    q = hmm_hits.select(
-        hmm_hits.pfam_id,
-        hmm_hits.bit_score,
-        where=((hmm_hits.accession == acc) & (hmm_hits.bit_score > 25)))
-    cur = DB.query(q, dictionary=True)
+    cur = DB.query(q, acc, dictionary=True)
     for hit in cur.fetchall():
         slc_hits[(acc, hit['pfam_id'])] = hit['bit_score'] - 20.0
         all_pfams.add(hit['pfam_id'])
@@ -88,7 +86,7 @@ Z = hac.linkage(hits_matrix, method='average', metric='cosine')
 logging.info('length of linkage (Z) matrix: {:d}'.format(len(Z)))
 
 ##### WRITE Z-matrix here
-print('TRUNCATE TABLE {!s};'.format(slc_like_clusters_linkage))
+slc_like_clusters_linkage.print_truncate_sql()
 for i in range(len(Z)):
     slc_like_clusters_linkage.print_insert_sql(
         {'branch_id': i+len(all_accessions),
@@ -303,7 +301,7 @@ for family_name, branch_ids in family2branch_id.items():
 #clusters.sort(key=lambda a: len(a[1]), reverse=True)
 # sort by branch_id
 clusters.sort(key=lambda a: a[1])
-print('TRUNCATE TABLE {!s};'.format(slc_like_clusters))
+slc_like_clusters.print_truncate_sql()
 for name, branch_id, members in clusters:
     member_names = ['/'.join([gene_symbols[x], x]) if x in gene_symbols else x
                     for x in members]
@@ -316,3 +314,6 @@ for name, branch_id, members in clusters:
              'branch_id': branch_id,
              'family_name': name})
 
+
+# apply queued writes (direct mode only)
+DB.flush()
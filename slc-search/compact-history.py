@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# vim: ai
+
+# moves superseded automatic versions older than a cutoff from history tables
+# to archive tables (<name>_history_archive), keeping all manual versions and
+# the versions needed to protect manual changes from being reverted, see
+# HistoryTable.superseded_versions()
+#
+#   python compact-history.py <cutoff> [table1 table2 ...]
+#
+# cutoff: a history id, or a timestamp like 2021-01-01 (versions before it)
+
+import sys
+import logging
+
+sys.path.append('./pylib')
+
+from historytable import open_database, HistoryTable
+
+#logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+DB = open_database()
+
+cutoff = sys.argv[1]
+if cutoff.isdigit(): cutoff = int(cutoff)
+
+tables = sys.argv[2:]
+if not tables:
+    tables = ['uniprot_proteins', 'uniprot_dbrefs']
+
+for table in tables:
+    HistoryTable(table, DB).print_compact_sql(cutoff)
+
+# apply queued writes (direct mode only)
+DB.flush()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# vim: ai
+
+# compares the indexes of the tables used by the pipeline with the lookups
+# done by pylib/historytable.py and the scripts, and prints CREATE INDEX
+# statements for the missing ones (applied directly with SLC_DB_DIRECT=1)
+# with --explain, the queries generated for each table are EXPLAINed and
+# the ones that scan a whole table are reported (on stderr)
+#
+#   python index-advisor.py [--explain] [table1 table2 ...]
+
+import sys
+import logging
+
+import sql
+
+sys.path.append('./pylib')
+
+from historytable import open_database, HistoryTable, Table
+
+#logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+DB = open_database()
+
+# history tables -> columns records are looked up by besides record_id
+history_tables = {
+    'pfam_domains': (),
+    'slc_families_defining_members': (),
+    'slc_like': ('accession',),
+    'slc_like_cluster_constraints': (),
+    'tcdb_families': (),
+    'tcdb_members': (),
+    'tcdb_sequences': (),
+    'uniprot_dbrefs': ('accession',),
+    'uniprot_proteins': ('accession',),
+}
+
+# ephemeral tables -> columns used in WHERE and JOIN conditions of the
+# scripts
+ephemeral_tables = {
+    'hmm_hits': [('accession', 'bit_score')],
+    'hmm_hits_clusters': [('accession',)],
+    'slc_like_clusters': [('accession',)],
+}
+
+explain = ('--explain' in sys.argv[1:])
+tables = [x for x in sys.argv[1:] if x != '--explain']
+if not tables:
+    tables = sorted(list(history_tables.keys()) +
+                    list(ephemeral_tables.keys()))
+
+# scans of derived tables (<derived2>, ...) are not reported
+full_scans = lambda plan: [x[0] for x in plan if (x[1] == 'ALL') and
+                           not str(x[0]).startswith('<')]
+
+def report(table, label, query):
+    try:
+        plan = DB.explain(query)
+    except Exception as e:
+        logging.warning('{}: {}: EXPLAIN failed: {}'.format(table, label, e))
+        return
+    scans = full_scans(plan)
+    if scans:
+        logging.warning('{}: {}: full scan of {}'.format(
+            table, label, ', '.join(sorted(set([str(x) for x in scans])))))
+    else:
+        logging.info('{}: {}: indexed'.format(table, label))
+
+for table in tables:
+    if table in history_tables:
+        key_fields = history_tables[table]
+        h = HistoryTable(table, DB)
+        columns = DB.get_columns(table + '_history')
+        if not columns:
+            logging.warning('table {}_history not found'.format(table))
+            continue
+        key_fields = [x for x in key_fields if x in columns]
+        h.print_index_sql(key_fields)
+        if not explain: continue
+        # lookups of pylib/historytable.py with values of the first record
+        cur = DB.query('SELECT * FROM {!s} ORDER BY `id` DESC LIMIT 1;'.format(
+            h._history), dictionary=True)
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            logging.warning('{}_history is empty, nothing to '
+                            'EXPLAIN'.format(table))
+            continue
+        row = dict(row)
+        field = [x for x in columns if x not in
+                 ('id', 'record_id', 'manual', 'deleted', 'timestamp',
+                  'user', 'comments')][0]
+        report(table, 'get_field_changes by record_id',
+               h.field_changes_sql(field, {'record_id': row['record_id']}))
+        report(table, 'versions by record_id',
+               h.versions_sql('record_id', [row['record_id']]))
+        report(table, 'as_of', h.as_of(row['id']))
+        for key in key_fields:
+            report(table, 'get_field_changes by {}'.format(key),
+                   h.field_changes_sql(field, {key: row[key]}))
+            report(table, 'versions by {}'.format(key),
+                   h.versions_sql(key, [row[key]]))
+            report(table, 'current rows by {}'.format(key),
+                   h.select(where=(sql.Column(h, key) == row[key])))
+    elif table in ephemeral_tables:
+        t = Table(table, DB)
+        indexes = dict([('{}_{}'.format(table, '_'.join(x)), x)
+                        for x in ephemeral_tables[table]])
+        DB.print_index_sql(t, indexes)
+        if not explain: continue
+        cur = DB.query('SELECT * FROM {!s} LIMIT 1;'.format(t),
+                       dictionary=True)
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            logging.warning('{} is empty, nothing to EXPLAIN'.format(table))
+            continue
+        row = dict(row)
+        for columns in ephemeral_tables[table]:
+            report(table, 'rows by {}'.format(columns[0]),
+                   t.select(where=(sql.Column(t, columns[0]) ==
+                                   row[columns[0]])))
+    else:
+        logging.warning('unknown table {}'.format(table))
+
+# apply queued writes (direct mode only)
+DB.flush()
@@ -13,14 +13,14 @@ import os.path
 import subprocess
 import itertools
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table
 
 import hashlib
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 slc_like = HistoryTable('slc_like', DB)
 slc_like_clusters = Table('slc_like_clusters', DB)
@@ -38,14 +38,13 @@ q = slc_like.join(
     slc_like_clusters.family_name,
     uniprot_proteins.tax_id,
     uniprot_proteins.seq_fasta,
-    where=(slc_like.status >= 0)
+    where=(slc_like.status >= 0),
+    order_by=(slc_like_clusters.family_name, slc_like.accession)
 )
 
-cur = DB.query(q, dictionary=True)
-all_accessions = cur.fetchall()
-cur.close()
-
-all_accessions.sort(key=lambda a: a['family_name'])
+# rows are streamed from the database, only the members of one family are
+# kept in memory
+all_accessions = DB.iterate(q, dictionary=True)
 
 # branch_id IS NOT compatible with family_name
 # one family can have multiple branches, sometimes it's not possible to merge
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import bisect
+import collections
+import concurrent.futures
+import io
+import os
+import struct
+import zlib
+
+# BGZF files (as written by bgzip of htslib): gzip files made of blocks of at
+# most 64 KiB of compressed and uncompressed data, each a gzip member with the
+# size of the block in a 'BC' extra field. any gzip reader can read them.
+# positions in them are virtual offsets:
+#   (offset of the block in the file << 16) | offset in the uncompressed block
+# so a reader only needs to decompress the block at the position.
+#   f = BgzfWriter('uniprot_sprot.txt.bgz')
+#   f.write(data)                       # f.tell() is a virtual offset
+#   f.close()
+#   f = BgzfReader('uniprot_sprot.txt.bgz')
+#   f.seek(virtual_offset)
+#   data = f.read(n)
+# for reading a whole file, open_parallel() decompresses the blocks in threads.
+
+# uncompressed data per block, like bgzip
+BLOCK_SIZE = 0xff00
+# ID1 ID2 CM FLG MTIME XFL OS XLEN, then the subfield BC with SLEN 2 and BSIZE
+_header = struct.Struct('<4BI2BH2B2H')
+_trailer = struct.Struct('<2I')
+# the empty block at the end of every BGZF file
+EOF_BLOCK = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+             b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+def make_virtual_offset(block_start, within_block):
+    return (block_start << 16) | within_block
+
+def split_virtual_offset(virtual_offset):
+    return (virtual_offset >> 16, virtual_offset & 0xffff)
+
+def compress_block(data, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    block_size = _header.size + len(cdata) + _trailer.size
+    if block_size > 1 << 16:
+        raise ValueError('BGZF block too large ({:d} bytes)'.format(block_size))
+    return (_header.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'),
+                         2, block_size-1) + cdata +
+            _trailer.pack(zlib.crc32(data), len(data)))
+
+# the next block of a binary file as bytes, or None at the end
+def read_raw_block(f):
+    header = f.read(12)
+    if not header: return None
+    if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError('not a BGZF block at offset {:d} of {}'.format(
+            f.tell()-len(header), getattr(f, 'name', f)))
+    xlen, = struct.unpack('<H', header[10:12])
+    extra = f.read(xlen)
+    block_size = None
+    i = 0
+    while i+4 <= len(extra):
+        slen, = struct.unpack('<H', extra[i+2:i+4])
+        if extra[i:i+2] == b'BC' and slen == 2:
+            block_size, = struct.unpack('<H', extra[i+4:i+6])
+            block_size += 1
+        i += 4+slen
+    if block_size is None:
+        raise ValueError('gzip member without BGZF size in {}'.format(
+            getattr(f, 'name', f)))
+    rest = f.read(block_size-12-xlen)
+    if len(rest) < block_size-12-xlen:
+        raise ValueError('truncated BGZF block in {}'.format(
+            getattr(f, 'name', f)))
+    return header + extra + rest
+
+# the uncompressed data of a block returned by read_raw_block()
+def decompress_block(raw):
+    xlen, = struct.unpack('<H', raw[10:12])
+    data = zlib.decompress(raw[12+xlen:-8], -15)
+    crc, size = _trailer.unpack(raw[-8:])
+    if (len(data) != size) or (zlib.crc32(data) != crc):
+        raise ValueError('BGZF block fails CRC check')
+    return data
+
+# True if filename starts with a BGZF block
+def is_bgzf(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    return (len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and
+            header[12:14] == b'BC')
+
+class BgzfWriter(object):
+    def __init__(self, filename, level=6):
+        self._f = open(filename, 'wb')
+        self.level = level
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+
+    def _write_block(self, data):
+        self._f.write(compress_block(data, self.level))
+
+    # start the next data in a new block, e.g. so a record that fits into one
+    # block isn't split across two
+    def flush(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    # virtual offset of the next byte written
+    def tell(self):
+        return make_virtual_offset(self._f.tell(), len(self._buffer))
+
+    def close(self):
+        if self._f.closed: return
+        self.flush()
+        self._f.write(EOF_BLOCK)
+        self._f.close()
+
+# random access to a BGZF file by virtual offsets, only the blocks read are
+# decompressed, the last one is kept
+class BgzfReader(object):
+    def __init__(self, filename):
+        self._f = open(filename, 'rb')
+        self._block_start = None
+        self._block_end = None
+        self._data = b''
+        self._pos = 0
+
+    def _load_block(self, block_start):
+        if block_start == self._block_start: return
+        self._f.seek(block_start)
+        raw = read_raw_block(self._f)
+        self._block_start = block_start
+        if raw is None:
+            self._block_end = block_start
+            self._data = b''
+        else:
+            self._block_end = block_start + len(raw)
+            self._data = decompress_block(raw)
+
+    def seek(self, virtual_offset):
+        block_start, within_block = split_virtual_offset(virtual_offset)
+        self._load_block(block_start)
+        if within_block > len(self._data):
+            raise ValueError('virtual offset {:d} beyond its block'.format(
+                virtual_offset))
+        self._pos = within_block
+
+    def tell(self):
+        if self._block_start is None: return 0
+        if (self._pos == len(self._data)) and self._data:
+            # the start of the next block
+            return make_virtual_offset(self._block_end, 0)
+        return make_virtual_offset(self._block_start, self._pos)
+
+    # at most size bytes from the current position, less only at the end
+    def read(self, size):
+        if self._block_start is None: self._load_block(0)
+        chunks = []
+        while size > 0:
+            if self._pos >= len(self._data):
+                if self._block_end == self._block_start: break
+                self._load_block(self._block_end)
+                self._pos = 0
+                continue
+            chunk = self._data[self._pos:self._pos+size]
+            chunks.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._f.close()
+
+# maps offsets in the uncompressed data of a BGZF file to virtual offsets,
+# blocks are read but not decompressed (the size is in the trailer)
+class BlockTable(object):
+    def __init__(self, filename):
+        self._starts = []
+        self._offsets = []
+        offset = 0
+        with open(filename, 'rb') as f:
+            while True:
+                start = f.tell()
+                raw = read_raw_block(f)
+                if raw is None: break
+                size, = struct.unpack('<I', raw[-4:])
+                if size == 0: continue
+                self._starts.append(start)
+                self._offsets.append(offset)
+                offset += size
+        self.size = offset
+
+    def virtual_offset(self, offset):
+        i = bisect.bisect_right(self._offsets, offset)-1
+        if i < 0: return 0
+        return make_virtual_offset(self._starts[i], offset-self._offsets[i])
+
+# binary stream of the decompressed data of a BGZF file, the main thread only
+# reads the blocks, they are decompressed in threads (zlib releases the GIL)
+class _ParallelRaw(io.RawIOBase):
+    def __init__(self, filename, threads):
+        self._f = open(filename, 'rb')
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._read_ahead = 4*threads
+        self._pending = collections.deque()
+        self._data = memoryview(b'')
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while (not self._eof) and (len(self._pending) < self._read_ahead):
+            raw = read_raw_block(self._f)
+            if raw is None:
+                self._eof = True
+                break
+            self._pending.append(self._executor.submit(decompress_block, raw))
+
+    def readinto(self, b):
+        while not self._data:
+            self._fill()
+            if not self._pending: return 0
+            self._data = memoryview(self._pending.popleft().result())
+        n = min(len(b), len(self._data))
+        b[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending: future.cancel()
+            self._executor.shutdown()
+            self._f.close()
+        super(_ParallelRaw, self).close()
+
+# buffered binary stream of the whole decompressed data of a BGZF file,
+# decompressed in threads threads (by default the SLC_BGZF_THREADS
+# environment variable or the number of cores)
+def open_parallel(filename, threads=None):
+    if threads is None:
+        threads = int(os.environ.get('SLC_BGZF_THREADS') or
+                      os.cpu_count() or 1)
+    return io.BufferedReader(_ParallelRaw(filename, max(threads, 1)),
+                             buffer_size=1 << 20)
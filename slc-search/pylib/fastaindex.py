@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import tempfile
+
+from bgzf import BgzfReader, BlockTable, is_bgzf, open_parallel
+
+# accession of a FASTA header line (bytes), e.g. P12345 of
+# ">sp|P12345|NAME_HUMAN ...", or the first word if it has no |
+def header_accession(line):
+    word = line[1:].split(None, 1)[0] if line[1:].strip() else b''
+    parts = word.split(b'|')
+    return parts[1] if len(parts) > 1 else word
+
+# the records of a FASTA file (binary): (accession, offset, length), a
+# record is the header line and the sequence lines up to the next header
+# or blank line, like sync-uniprot-info.py has always read them
+def fasta_records(f):
+    offset = 0
+    current = None
+    for line in f:
+        if line.startswith(b'>'):
+            if current is not None: yield current + (offset-current[1],)
+            current = (header_accession(line), offset)
+        elif not line.strip():
+            if current is not None: yield current + (offset-current[1],)
+            current = None
+        offset += len(line)
+    if current is not None: yield current + (offset-current[1],)
+
+# index of the records of a file by accession: the offset and length of each
+# record, e.g. of the FASTA records of uniprot-all.fasta:
+#   index = FastaIndex('uniprot-all.fasta')
+#   record = index.get('P12345')        # header and sequence lines, or None
+# subclasses define the records with _records(f), see FastaIndex.
+# the index is kept in index_filename (default: <filename>.accidx), sorted
+# by accession and searched in place, so memory stays constant. it is
+# rebuilt when the size or modification time of the file changes.
+# if an accession occurs more than once, the first record counts.
+# for BGZF files (see pylib/bgzf.py) the offsets are virtual offsets, only
+# the blocks of the records read are decompressed.
+class AccessionIndex(object):
+    header = b'#fasta-accession-index'
+    # records sorted in memory at once while building the index
+    chunk_size = 1000000
+
+    def __init__(self, filename, index_filename=None):
+        if index_filename is None: index_filename = filename + '.accidx'
+        self.filename = filename
+        self.index_filename = index_filename
+        self.bgzf = is_bgzf(filename)
+        if not self._is_current():
+            self.build()
+        if self.bgzf: self._data = BgzfReader(filename)
+        else: self._data = open(filename, 'rb')
+        self._index_file = open(index_filename, 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        # the sorted lines start after the header line
+        self._start = self._index.find(b'\n')+1
+
+    # (accession, offset, length) of the records of a binary stream of the
+    # (uncompressed) file, offsets are positions in the stream
+    def _records(self, f):
+        raise NotImplementedError
+
+    def _stamp(self):
+        stat = os.stat(self.filename)
+        return b'\t'.join([self.header, str(stat.st_size).encode(),
+                           str(stat.st_mtime_ns).encode()]) + b'\n'
+
+    def _is_current(self):
+        if not os.path.exists(self.index_filename): return False
+        with open(self.index_filename, 'rb') as f:
+            return f.readline() == self._stamp()
+
+    # sort the records of the file into the index file, in chunks of
+    # chunk_size records that are merged at the end
+    def build(self):
+        logging.info('indexing {}'.format(self.filename))
+        stamp = self._stamp()
+        index_dir = os.path.dirname(os.path.abspath(self.index_filename))
+        chunks = []
+        n_records = 0
+        try:
+            if self.bgzf:
+                f = open_parallel(self.filename)
+                table = BlockTable(self.filename)
+                records = ((accession, table.virtual_offset(offset), length)
+                           for accession, offset, length in self._records(f))
+            else:
+                f = open(self.filename, 'rb')
+                records = self._records(f)
+            with f:
+                while True:
+                    chunk = list(itertools.islice(records, self.chunk_size))
+                    if not chunk: break
+                    n_records += len(chunk)
+                    chunk.sort()
+                    tmp = tempfile.TemporaryFile(dir=index_dir)
+                    tmp.writelines([b'%s\t%d\t%d\n' % x for x in chunk])
+                    tmp.seek(0)
+                    chunks.append(tmp)
+            tmp_filename = self.index_filename + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                f.write(stamp)
+                last = None
+                # sorted by accession, then offset: the first record of an
+                # accession comes first
+                for line in heapq.merge(*chunks, key=self._sort_key):
+                    accession = line.split(b'\t', 1)[0]
+                    if accession == last: continue
+                    f.write(line)
+                    last = accession
+            os.replace(tmp_filename, self.index_filename)
+        finally:
+            for tmp in chunks:
+                tmp.close()
+        logging.info('indexed {:d} records of {}'.format(n_records,
+                                                          self.filename))
+
+    @staticmethod
+    def _sort_key(line):
+        accession, offset, length = line.split(b'\t')
+        return (accession, int(offset))
+
+    # (offset, length) of the record of accession, or None
+    # binary search over the lines of the index file
+    def locate(self, accession):
+        key = accession.encode('utf-8')
+        index = self._index
+        lo, hi = self._start, len(index)
+        while lo < hi:
+            mid = (lo+hi) // 2
+            start = max(index.rfind(b'\n', lo, mid)+1, lo)
+            end = index.find(b'\n', start)
+            if index[start:end].split(b'\t', 1)[0] < key:
+                lo = end+1
+            else:
+                hi = start
+        if lo >= len(index): return None
+        end = index.find(b'\n', lo)
+        found, offset, length = index[lo:end].split(b'\t')
+        if found != key: return None
+        return (int(offset), int(length))
+
+    def __contains__(self, accession):
+        return self.locate(accession) is not None
+
+    # the record of accession as bytes, or None
+    def get_bytes(self, accession):
+        location = self.locate(accession)
+        if location is None: return None
+        return self._read(*location)
+
+    def _read(self, offset, length):
+        if self.bgzf:
+            self._data.seek(offset)
+            return self._data.read(length)
+        return os.pread(self._data.fileno(), length, offset)
+
+    def close(self):
+        self._index.close()
+        self._index_file.close()
+        self._data.close()
+
+# index of the records of a FASTA file (uncompressed or BGZF) by accession
+class FastaIndex(AccessionIndex):
+    def _records(self, f):
+        return fasta_records(f)
+
+    # the record of accession (header and sequence lines) or None
+    def get(self, accession):
+        record = self.get_bytes(accession)
+        if record is None: return None
+        return record.decode('utf-8')
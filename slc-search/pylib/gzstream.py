@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import gzip
+import io
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import zlib
+
+# opens gzip files for reading with decompression outside the reading thread,
+# so decompression and parsing run on two cores:
+#   f = open_gz('uniprot_sprot.txt.gz')               # text stream
+#   f = open_gz('uniprot_sprot.txt.gz', 'rb')         # binary stream
+# backends:
+#   igzip: an igzip -dc process (ISA-L, the fastest)
+#   pigz: a pigz -dc process
+#   thread: zlib in a background thread (zlib releases the GIL)
+#   gzip: the gzip module in the reading thread, like gzip.open
+# by default the backend is the SLC_GZ_BACKEND environment variable or the
+# first of igzip and pigz that is installed, else thread.
+BACKENDS = ('igzip', 'pigz', 'thread', 'gzip')
+
+def default_backend():
+    backend = os.environ.get('SLC_GZ_BACKEND')
+    if backend: return backend
+    for tool in ('igzip', 'pigz'):
+        if shutil.which(tool): return tool
+    return 'thread'
+
+# binary stream of the decompressed output of a process
+class _ProcessRaw(io.RawIOBase):
+    def __init__(self, args, filename):
+        self.filename = filename
+        self._process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                         bufsize=1 << 20)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._process.stdout.readinto(b)
+        if n == 0:
+            # a corrupt or truncated file must not pass as a short one
+            if self._process.wait() != 0:
+                raise OSError('{} failed on {} (exit code {:d})'.format(
+                    self._process.args[0], self.filename,
+                    self._process.returncode))
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self._process.poll() is None: self._process.kill()
+            self._process.stdout.close()
+            self._process.wait()
+        super(_ProcessRaw, self).close()
+
+# binary stream of a gzip file decompressed by a background thread, at most
+# read_ahead chunks are kept ready
+# the thread is started by the first read, so a process pool forked before
+# that (like the one of uniprot.scan_entries()) doesn't copy a process with
+# a running thread
+class _ThreadRaw(io.RawIOBase):
+    chunk_size = 1 << 20
+    read_ahead = 16
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, 'rb')
+        self._queue = queue.Queue(self.read_ahead)
+        self._stop = threading.Event()
+        self._data = memoryview(b'')
+        self._eof = False
+        self._thread = None
+
+    def readable(self):
+        return True
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # runs in the thread: puts chunks of decompressed data, then None, or
+    # the exception that stopped it
+    def _decompress(self):
+        try:
+            d = zlib.decompressobj(31)
+            # a member has been started but not finished
+            pending = False
+            while not self._stop.is_set():
+                cdata = self._f.read(self.chunk_size)
+                if not cdata: break
+                while cdata:
+                    pending = True
+                    data = d.decompress(cdata)
+                    if data and not self._put(data): return
+                    if not d.eof: break
+                    # the next member of a multi-member file (e.g. BGZF)
+                    pending = False
+                    cdata = d.unused_data
+                    d = zlib.decompressobj(31)
+            if pending:
+                raise EOFError('{} is truncated'.format(self.filename))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def readinto(self, b):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._decompress,
+                                            daemon=True)
+            self._thread.start()
+        while not self._data:
+            if self._eof: return 0
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._data = memoryview(item)
+        n = min(len(b), len(self._data))
+        b[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            if self._thread is not None: self._thread.join()
+            self._f.close()
+        super(_ThreadRaw, self).close()
+
+# a gzip file as buffered binary (mode 'rb') or text stream (mode 'rt'),
+# decompressed by backend (see BACKENDS, default: default_backend())
+def open_gz(filename, mode='rt', encoding='utf-8', backend=None):
+    if mode not in ('rt', 'rb', 'r'):
+        raise ValueError('open_gz() only reads, mode {!r}'.format(mode))
+    if backend is None: backend = default_backend()
+    if backend in ('igzip', 'pigz'):
+        f = io.BufferedReader(_ProcessRaw([backend, '-dc', filename],
+                                          filename), buffer_size=1 << 20)
+    elif backend == 'thread':
+        f = io.BufferedReader(_ThreadRaw(filename), buffer_size=1 << 20)
+    elif backend == 'gzip':
+        f = gzip.open(filename, 'rb')
+    else:
+        raise ValueError('unknown gzip backend {!r}, expected one of '
+                         '{}'.format(backend, ', '.join(BACKENDS)))
+    if mode == 'rb': return f
+    return io.TextIOWrapper(f, encoding=encoding)
@@ -6,61 +6,941 @@ import sql.aggregate
 import logging
 import collections.abc
 import sqlite3
+import os
+import json
+import re
+import sys
+import time
+import atexit
+import threading
+import csv
+import io
+import weakref
+import asyncio
+import concurrent.futures
+import itertools
 
 #logging.basicConfig(level=logging.DEBUG)
 
+# column names of tables, shared by all Database instances
+#   (database, table) -> [column1, column2, ...]
+_column_cache = dict()
+# file the column cache is saved to after each change, if set
+_column_cache_file = None
+
+# read cached columns from a JSON file (if it exists) and keep it updated,
+# by default the file named by the SLC_COLUMN_CACHE environment variable
+def load_column_cache(filename):
+    global _column_cache_file
+    if os.path.exists(filename):
+        with open(filename, 'rt', encoding='utf-8') as f:
+            for database, table, columns in json.load(f):
+                _column_cache[(database, table)] = columns
+    _column_cache_file = filename
+
+def save_column_cache(filename):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wt', encoding='utf-8') as f:
+        json.dump([[database, table, columns] for (database, table), columns
+                   in sorted(_column_cache.items())], f)
+    os.replace(tmp_filename, filename)
+
+# forget the cached columns of a table, all tables of a database, or
+# everything
+def invalidate_column_cache(database=None, table=None):
+    for key in list(_column_cache.keys()):
+        if (((database is None) or (key[0] == database)) and
+            ((table is None) or (key[1] == table))):
+            del _column_cache[key]
+    if _column_cache_file is not None:
+        save_column_cache(_column_cache_file)
+
+if os.environ.get('SLC_COLUMN_CACHE'):
+    load_column_cache(os.environ['SLC_COLUMN_CACHE'])
+
+# statistics of the queries run by Database.query(), grouped by fingerprint
+# (the query without its parameters), see Database(profile=...)
+# top: number of queries in the report printed to stderr at exit
+# json_filename: file the statistics of all queries are saved to at exit
+# queries of several threads (e.g. of AsyncDatabase) may be recorded at the
+# same time, the statistics are only changed while holding _lock
+class QueryProfiler(object):
+    def __init__(self, top=20, json_filename=None):
+        self.top = top
+        self.json_filename = json_filename
+        # fingerprint -> {'count', 'time', 'rows', 'reconnects', 'example'}
+        self.stats = dict()
+        self._lock = threading.Lock()
+        atexit.register(self.report)
+
+    # the query with literals and placeholders replaced by ?, lists of values
+    # (IN (...), multi-row VALUES) collapsed and whitespace normalized
+    def fingerprint(statement):
+        s = re.sub(r"'(?:[^'\\]|\\.|'')*'", '?', statement)
+        s = re.sub(r'\b\d+(?:\.\d+)?\b|%s', '?', s)
+        s = re.sub(r'\s+', ' ', s).strip()
+        s = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', s)
+        s = re.sub(r'\(\?\)(?:\s*,\s*\(\?\))+', '(?), ...', s)
+        s = re.sub(r'(?:\s*,\s*\?){2,}', ', ...', s)
+        return s
+
+    # the entry of statement, call with _lock held
+    def _entry(self, statement):
+        fingerprint = QueryProfiler.fingerprint(statement)
+        if fingerprint not in self.stats:
+            self.stats[fingerprint] = {'count': 0, 'time': 0.0, 'rows': 0,
+                                       'reconnects': 0,
+                                       'example': statement}
+        return self.stats[fingerprint]
+
+    # record an executed statement, returns a cursor that adds the time and
+    # number of rows of fetches to the same entry
+    def executed(self, cur, statement, seconds, reconnects=0):
+        if isinstance(cur, ProfiledCursor): cur = cur.cursor
+        with self._lock:
+            entry = self._entry(statement)
+            entry['count'] += 1
+            entry['time'] += seconds
+            entry['reconnects'] += reconnects
+        return ProfiledCursor(cur, entry, self._lock)
+
+    def report(self):
+        with self._lock:
+            stats = dict([(k, dict(v)) for k, v in self.stats.items()])
+        if not stats: return
+        entries = sorted(stats.items(), key=lambda x: -x[1]['time'])
+        total = sum([x['time'] for x in stats.values()])
+        n = sum([x['count'] for x in stats.values()])
+        print('query profile: {:d} queries, {:d} distinct, {:.3f} s'.format(
+            n, len(entries), total), file=sys.stderr)
+        print('{:>10} {:>8} {:>10} {:>10} {:>5}  {}'.format(
+            'time [s]', 'count', 'ms/query', 'rows', 'recon', 'query'),
+            file=sys.stderr)
+        for fingerprint, entry in entries[:self.top]:
+            print('{:10.3f} {:8d} {:10.3f} {:10d} {:5d}  {}'.format(
+                entry['time'], entry['count'],
+                1000.0*entry['time']/max(entry['count'], 1), entry['rows'],
+                entry['reconnects'],
+                fingerprint if len(fingerprint) <= 200 else
+                fingerprint[:197]+'...'), file=sys.stderr)
+        if self.json_filename is not None:
+            with open(self.json_filename, 'wt', encoding='utf-8') as f:
+                json.dump([dict(entry, fingerprint=fingerprint)
+                           for fingerprint, entry in entries], f, indent=1)
+
+# cursor wrapper counting the fetched rows and fetch time for QueryProfiler
+# lock: the lock of the profiler, held while the entry is changed
+class ProfiledCursor(object):
+    def __init__(self, cursor, entry, lock):
+        self.cursor = cursor
+        self._entry = entry
+        self._lock = lock
+
+    def _fetched(self, start, rows):
+        seconds = time.perf_counter()-start
+        with self._lock:
+            self._entry['time'] += seconds
+            self._entry['rows'] += rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self._fetched(start, int(row is not None))
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = time.perf_counter()
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None: return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+# placeholder for a value that is given each time a prepared query is run,
+# see Database.prepare()
+class Parameter(object):
+    def __init__(self, name=None):
+        self.name = name
+    def __repr__(self):
+        return 'Parameter({!r})'.format(self.name)
+
+# SQL text of a query, compiled once by Database.prepare()
+# run it with DB.query(prepared, value1, value2, ...), the values replace the
+# Parameter placeholders in order, other params of the query are kept
+class PreparedQuery(object):
+    def __init__(self, statement, params):
+        self.statement = statement
+        self.params = tuple(params)
+        self._slots = [i for i, x in enumerate(self.params)
+                       if isinstance(x, Parameter)]
+    def bind(self, values):
+        if len(values) != len(self._slots):
+            raise TypeError('prepared query takes {:d} values, {:d} '
+                            'given'.format(len(self._slots), len(values)))
+        params = list(self.params)
+        for i, v in zip(self._slots, values):
+            params[i] = v
+        return tuple(params)
+
+# the rows of a query, fetched right away so the cursor can be closed (or
+# reused, if it is prepared) and its connection given back to the pool
+class QueryResult(object):
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.column_names = cursor.column_names
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        if cursor.description is None: self._rows = []
+        else: self._rows = cursor.fetchall()
+        self.rowcount = max(self.rowcount, len(self._rows))
+        self._i = 0
+    def fetchone(self):
+        if self._i >= len(self._rows): return None
+        self._i += 1
+        return self._rows[self._i-1]
+    def fetchmany(self, size=1):
+        rows = self._rows[self._i:self._i+size]
+        self._i += len(rows)
+        return rows
+    def fetchall(self):
+        rows = self._rows[self._i:]
+        self._i = len(self._rows)
+        return rows
+    def __iter__(self):
+        return iter(self.fetchall())
+    def close(self):
+        self._rows = []
+
+# statements that query() may run again after a failure
+_read_only_statement = re.compile(r'\s*(SELECT|SHOW|EXPLAIN|DESCRIBE|DESC)\b',
+                                  re.IGNORECASE)
+
+# the process-wide profiler used by Database(profile=True)
+_profiler = None
+
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = QueryProfiler(
+            top=int(os.environ.get('SLC_PROFILE_TOP', '20')),
+            json_filename=os.environ.get('SLC_PROFILE_JSON') or None)
+    return _profiler
+
 class Database(object):
+    insert_ignore = 'INSERT IGNORE'
+    # SELECT ... INTO @variable is supported, see Table.print_insert_sql()
+    has_user_variables = True
+    # file name extensions of bulk exports, see export_row()
+    export_extension = 'tsv'
+    export_loader = 'load.sql'
+    # starts a transaction in printed SQL, see write_together()
+    begin_sql = 'START TRANSACTION;'
+    # direct: apply the writes of Table and HistoryTable (see write()) to the
+    # database instead of printing SQL to stdout, by default set by the
+    # SLC_DB_DIRECT environment variable
+    # batch_size: number of queued statements executed in one transaction
+    # max_allowed_packet: maximum size of printed multi-row INSERT statements,
+    # should not exceed the max_allowed_packet setting of the server
+    # profile: record the time, fetched rows and reconnects of queries (see
+    # QueryProfiler), by default set by the SLC_PROFILE environment variable
+    # pool_size: maximum number of connections shared by the threads using
+    # this database, by default set by the SLC_DB_POOL_SIZE environment
+    # variable (4 if not set), see _acquire()
+    # export_dir: write the rows of Table to data files and load scripts in
+    # this directory (see export_row()), by default set by the
+    # SLC_EXPORT_DIR environment variable
     def __init__(self, host='127.0.0.1', database='your_db_name',
-                 user='your_username', password='your_password'):
+                 user='your_username', password='your_password',
+                 direct=None, batch_size=1000, max_allowed_packet=1024*1024,
+                 profile=None, pool_size=None, export_dir=None):
         self._name = database
         self._host = host
         self._user = user
         self._password = password
-        self.connect()
+        self._server_version = None
+        self._server_is_mariadb = False
+        if direct is None:
+            direct = os.environ.get('SLC_DB_DIRECT', '0') not in ('', '0')
+        self.direct = direct
+        self.batch_size = batch_size
+        # [(statement, [params1, params2, ...]), ...]
+        self._queue = []
+        self._n_queued = 0
+        self.max_allowed_packet = max_allowed_packet
+        # printed statement being collected by _combine()
+        self._combined = None
+        self._record_id_sequences_created = False
+        if export_dir is None:
+            export_dir = os.environ.get('SLC_EXPORT_DIR') or None
+        self.export_dir = export_dir
+        # table name -> {'table', 'filename', 'file', 'columns', ...}
+        self._exports = dict()
+        if profile is None:
+            profile = (os.environ.get('SLC_PROFILE', '0') not in ('', '0') or
+                       bool(os.environ.get('SLC_PROFILE_JSON')))
+        self.profiler = get_profiler() if profile else None
+        if pool_size is None:
+            pool_size = int(os.environ.get('SLC_DB_POOL_SIZE', '4'))
+        self.pool_size = pool_size
+        # failed connects and queries are retried max_retries times, waiting
+        # retry_delay seconds before the first retry and twice as long
+        # before each next one
+        self.max_retries = 5
+        self.retry_delay = 0.5
+        # connections idle for longer than this many seconds are pinged
+        # before they are used again
+        self.health_check_interval = 60
+        # [(connection, time it was released), ...]
+        self._idle = []
+        self._n_connections = 0
+        self._pool_lock = threading.Condition()
+        # the connection pinned to a thread by begin() or conn
+        self._local = threading.local()
+        # statement -> PreparedQuery, see prepare()
+        self._prepared = dict()
+        # connection -> {(statement, dictionary): prepared cursor}
+        self._prepared_cursors = weakref.WeakKeyDictionary()
         self.logger = logging.getLogger('mysql')
         #self.logger.setLevel(logging.DEBUG)
+        self.connect()
 
+    # check that the database can be connected to
     def connect(self):
-        self.conn = mysql.connector.connect(host=self._host,
-                                            database=self._name,
-                                            user=self._user,
-                                            password=self._password)
+        self._release(self._acquire())
+
+    # open a new connection, retrying with exponential backoff
+    # autocommit is on, so pooled connections see the latest data, writes
+    # that belong together are wrapped in begin() and commit()
+    def _new_connection(self, **kwargs):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries+1):
+            try:
+                return mysql.connector.connect(host=self._host,
+                                               database=self._name,
+                                               user=self._user,
+                                               password=self._password,
+                                               autocommit=True,
+                                               **kwargs)
+            except (mysql.connector.errors.OperationalError,
+                    mysql.connector.errors.InterfaceError) as e:
+                if attempt == self.max_retries: raise
+                self.logger.warning('connecting to {} failed ({}), retrying '
+                                    'in {:.1f} s'.format(self._host, e, delay))
+                time.sleep(delay)
+                delay *= 2
+
+    # the connection of this thread: the one pinned by begin() (or conn), or
+    # an idle one from the pool, or a new one if there are less than
+    # pool_size connections, otherwise wait until one is released
+    def _acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None: return conn
+        with self._pool_lock:
+            while (not self._idle) and (self._n_connections >= self.pool_size):
+                self._pool_lock.wait()
+            if self._idle:
+                conn, released = self._idle.pop()
+            else:
+                self._n_connections += 1
+                released = None
+        if released is None:
+            try:
+                return self._new_connection()
+            except Exception:
+                self._discard(None)
+                raise
+        if time.monotonic()-released > self.health_check_interval:
+            try:
+                conn.ping(reconnect=False)
+            except mysql.connector.errors.Error:
+                self.logger.info('dropping stale connection')
+                self._discard(conn)
+                return self._acquire()
+        return conn
+
+    # return a connection to the pool, unless it is pinned to this thread
+    def _release(self, conn):
+        if conn is getattr(self._local, 'conn', None): return
+        with self._pool_lock:
+            self._idle.append((conn, time.monotonic()))
+            self._pool_lock.notify()
+
+    # close a broken connection and make room for a new one
+    def _discard(self, conn):
+        if conn is not None:
+            if conn is getattr(self._local, 'conn', None):
+                self._local.conn = None
+            try:
+                conn.close()
+            except mysql.connector.errors.Error:
+                pass
+        with self._pool_lock:
+            self._n_connections -= 1
+            self._pool_lock.notify()
+
+    # the connection of this thread, it is pinned to the thread until
+    # commit() or rollback() is called
+    @property
+    def conn(self):
+        conn = self._acquire()
+        self._local.conn = conn
+        return conn
 
+    # (major, minor, patch) of the server
+    def server_version(self):
+        if self._server_version is None:
+            conn = self._acquire()
+            try:
+                info = conn.get_server_info()
+            finally:
+                self._release(conn)
+            self._server_version = tuple(
+                [int(x) for x in info.split('-')[0].split('.')[:3]])
+            self._server_is_mariadb = ('mariadb' in info.lower())
+        return self._server_version
+
+    def has_window_functions(self):
+        version = self.server_version()
+        if self._server_is_mariadb:
+            return version >= (10, 2, 0)
+        return version >= (8, 0, 0)
+
+    # commit and unpin the connection of this thread
     def commit(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None: return
         self.logger.debug('committing records')
-        self.conn.commit()
+        conn.commit()
+        self._local.conn = None
+        self._release(conn)
 
-    def close(self):
-        self.conn.close()
+    # start a transaction on a connection pinned to this thread, queries of
+    # this thread use it until commit() or rollback()
+    def begin(self):
+        conn = self.conn
+        # end the implicit transaction of previous SELECTs
+        if conn.in_transaction: conn.commit()
+        conn.start_transaction()
 
-    def query(self, *args, cursor=None, dictionary=False):
+    def rollback(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None: return
+        try:
+            conn.rollback()
+        except mysql.connector.errors.Error:
+            self._discard(conn)
+            raise
+        self._local.conn = None
+        self._release(conn)
+
+    # statement: SQL with %s placeholders for params
+    # prints the statement, or queues it in direct mode, consecutive
+    # statements with the same text are executed with executemany()
+    def write(self, statement, params=()):
+        if not self.direct:
+            self._print_combined()
+            print(self.render(statement, params))
+            return
+        self._enqueue(statement, params)
+        if self._n_queued >= self.batch_size: self._execute_queue()
+
+    # statements: [(statement, params), ...] that are applied together or
+    # not at all: printed in a transaction of their own, or queued into the
+    # same batch in direct mode (the batch may grow beyond batch_size)
+    def write_together(self, statements):
+        if not self.direct:
+            self._print_combined()
+            print(self.begin_sql)
+            for statement, params in statements:
+                print(self.render(statement, params))
+            print('COMMIT;')
+            return
+        for statement, params in statements:
+            self._enqueue(statement, params)
+        if self._n_queued >= self.batch_size: self._execute_queue()
+
+    def _enqueue(self, statement, params):
+        if self._queue and (self._queue[-1][0] == statement):
+            self._queue[-1][1].append(tuple(params))
+        else:
+            self._queue.append((statement, [tuple(params)]))
+        self._n_queued += 1
+
+    # INSERT INTO table (keys) VALUES row
+    # row: SQL of the values with %s placeholders, {offset} is replaced by the
+    # position of the row in a multi-row INSERT: '' for the first one, '+1',
+    # '+2', ... for the next ones
+    # prologue: SQL to run before the INSERT statement
+    # consecutive printed rows of the same table and keys are collected into
+    # multi-row INSERT statements, see _combine()
+    def write_insert(self, table, keys, row, params=(), prologue=None):
+        head = 'INSERT INTO {} ({}) VALUES'.format(table, ', '.join(keys))
+        if self.direct:
+            if prologue is not None: self.write(prologue)
+            self.write('{} {};'.format(head, row.replace('{offset}', '')),
+                       params)
+            return
+        self._combine(head, row, params, ',\n', prologue=prologue)
+
+    # INSERT INTO table (keys) SELECT ... UNION ALL SELECT ...
+    # select: SELECT with %s placeholders, copying one row
+    # source: the id of the copied row, each id is copied only once in a
+    # statement to keep the order of the new rows
+    def write_insert_select(self, table, keys, select, params=(),
+                            source=None):
+        head = 'INSERT INTO {} ({})'.format(table, ', '.join(keys))
+        if self.direct:
+            self.write('{} {};'.format(head, select), params)
+            return
+        self._combine(head, select, params, '\nUNION ALL\n', source=source)
+
+    # collects printed statements "head part1 joiner part2 joiner ...;"
+    # while head and prologue stay the same and the statement is not longer
+    # than max_allowed_packet bytes (of UTF-8, as the server counts them)
+    def _combine(self, head, part, params, joiner, prologue=None,
+                 source=None):
+        c = self._combined
+        if ((c is not None) and
+            (((c['head'], c['prologue']) != (head, prologue)) or
+             ((source is not None) and (source in c['sources'])))):
+            self._print_combined()
+        if self._combined is None:
+            self._combined = {'head': head, 'prologue': prologue,
+                              'joiner': joiner, 'parts': [],
+                              'sources': set(),
+                              'size': len(head.encode('utf-8'))}
+        c = self._combined
+        n = len(c['parts'])
+        sql_part = self.render(
+            part.replace('{offset}', '+{:d}'.format(n) if n > 0 else ''),
+            params)
+        size = len(sql_part.encode('utf-8'))+len(joiner)
+        if (n > 0) and (c['size']+size > self.max_allowed_packet):
+            self._print_combined()
+            self._combine(head, part, params, joiner, prologue=prologue,
+                          source=source)
+            return
+        c['parts'].append(sql_part)
+        c['size'] += size
+        if source is not None: c['sources'].add(source)
+
+    def _print_combined(self):
+        if self._combined is None: return
+        c = self._combined
+        self._combined = None
+        if c['prologue'] is not None: print(c['prologue'])
+        print('{}\n{};'.format(c['head'], c['joiner'].join(c['parts'])))
+
+    # execute queued writes in one transaction
+    # (or print the last combined statement if not in direct mode)
+    # and finish bulk exports, see export_row()
+    def flush(self):
+        self._print_combined()
+        self._execute_queue()
+        self._finish_exports()
+
+    def _execute_queue(self):
+        if not self._queue: return
+        self.logger.debug('flushing {:d} statements'.format(self._n_queued))
+        self.begin()
         try:
-            if cursor is None: cur = self.conn.cursor(dictionary=dictionary)
-            else: cur = cursor
-            if isinstance(args[0], sql.Query):
-                self.logger.debug(repr(tuple(args[0])))
-                cur.execute(*tuple(args[0]))
-            elif isinstance(args[0], str):
-                self.logger.debug(repr(args))
-                cur.execute(args[0], tuple(args[1:]))
+            # closed before commit() gives the connection back to the pool
+            cur = self.conn.cursor()
+            try:
+                for statement, params in self._queue:
+                    statement = self.paramstyle(statement)
+                    start = time.perf_counter()
+                    if len(params) == 1: cur.execute(statement, params[0])
+                    else: cur.executemany(statement, params)
+                    if self.profiler is not None:
+                        self.profiler.executed(cur, statement,
+                                               time.perf_counter()-start)
+            finally:
+                cur.close()
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        self._queue = []
+        self._n_queued = 0
+
+    # convert %s placeholders to the paramstyle of the driver
+    def paramstyle(self, statement):
+        return statement
+
+    def truncate_sql(self, table):
+        return 'TRUNCATE TABLE {!s};'.format(table)
+
+    # SQL of a comparison of strings that is case sensitive
+    def case_sensitive(self, expression):
+        return 'BINARY {}'.format(expression)
+
+    # bulk export mode: instead of INSERT statements, Table writes its rows
+    # to a data file in export_dir and flush() writes a script loading it
+    # (plus TRUNCATE if export_truncate() was called)
+    def export_truncate(self, table):
+        self._export(table)['truncate'] = True
+
+    # keys: column names, the same for all rows of a table
+    def export_row(self, table, keys, values):
+        export = self._export(table)
+        if export['columns'] is None:
+            export['columns'] = list(keys)
+        elif export['columns'] != list(keys):
+            raise ValueError('exported rows of table {!s} need the same '
+                             'columns {!r}, got {!r}'.format(
+                                 table, export['columns'], list(keys)))
+        export['file'].write(self.export_line(values))
+        export['n_rows'] += 1
+
+    def _export(self, table):
+        if table._name not in self._exports:
+            filename = os.path.abspath(os.path.join(
+                self.export_dir, '{}.{}'.format(table._name,
+                                                self.export_extension)))
+            self._exports[table._name] = {
+                'table': table, 'filename': filename,
+                'file': open(filename, 'wt', encoding='utf-8', newline=''),
+                'columns': None, 'truncate': False, 'n_rows': 0}
+        return self._exports[table._name]
+
+    # one row of the data file, escaped for LOAD DATA: tab separated, \N is
+    # NULL
+    def export_line(self, values):
+        line = []
+        for v in values:
+            if v is None: line.append('\\N')
+            elif isinstance(v, (int, bool, float)):
+                line.append(Database.format(v))
             else:
-                self.logger.debug(repr(args))
-                cur.execute(*args)
-        except (mysql.connector.errors.OperationalError, AttributeError):
-            self.connect()
-            if cursor is None: cur = self.conn.cursor(dictionary=dictionary)
-            else: cur = cursor
-            if isinstance(args[0], sql.Query):
-                self.logger.debug(repr(tuple(args[0])))
-                cur.execute(*tuple(args[0]))
-            elif isinstance(args[0], str):
-                self.logger.debug(repr(args))
-                cur.execute(args[0], tuple(args[1:]))
+                line.append(str(v).translate(str.maketrans({
+                    '\0': '\\0',
+                    '\b': '\\b',
+                    '\n': '\\n',
+                    '\r': '\\r',
+                    '\t': '\\t',
+                    '\\': '\\\\',
+                    })))
+        return '\t'.join(line) + '\n'
+
+    def export_script(self, export):
+        table = export['table']
+        lines = []
+        if export['truncate']:
+            lines.append(self.truncate_sql(table))
+        if export['columns'] is not None:
+            lines.append(
+                "LOAD DATA LOCAL INFILE '{}' INTO TABLE {!s} "
+                "CHARACTER SET utf8mb4\n"
+                "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                "LINES TERMINATED BY '\\n'\n({});".format(
+                    Database.escape(export['filename']), table,
+                    ', '.join(['`{}`'.format(Database.escape(x))
+                               for x in export['columns']])))
+        return '\n'.join(lines) + '\n'
+
+    def _finish_exports(self):
+        for name, export in self._exports.items():
+            export['file'].close()
+            script = os.path.join(os.path.dirname(export['filename']),
+                                  '{}.{}'.format(name, self.export_loader))
+            with open(script, 'wt', encoding='utf-8') as f:
+                f.write(self.export_script(export))
+            self.logger.info('exported {:d} rows of {}, load them with '
+                             '{}'.format(export['n_rows'], name, script))
+        self._exports = dict()
+
+    # close the idle connections and the one pinned to this thread
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None: self._discard(conn)
+        with self._pool_lock:
+            idle = self._idle
+            self._idle = []
+            self._n_connections -= len(idle)
+        for conn, released in idle:
+            conn.close()
+
+    # column names of a table, in order
+    # served from the process-wide column cache, see load_column_cache()
+    def get_columns(self, table):
+        key = (self._name, table)
+        if key not in _column_cache:
+            columns = self._query_columns(table)
+            # don't remember tables that don't exist (yet)
+            if not columns: return columns
+            _column_cache[key] = columns
+            if _column_cache_file is not None:
+                save_column_cache(_column_cache_file)
+        return _column_cache[key][:]
+
+    def _query_columns(self, table):
+        info_schema = sql.Table('columns', 'information_schema')
+        q = info_schema.select(
+            info_schema.column_name,
+            where=((info_schema.table_schema == self._name) &
+                   (info_schema.table_name == table)),
+            order_by=info_schema.ordinal_position.asc)
+        cur = self.query(q)
+        columns = [x[0] for x in cur.fetchall()]
+        cur.close()
+        return columns
+
+    # reserve n consecutive record_ids of a table (or history table), returns
+    # the first one
+    # the next free record_id of each table is kept in record_id_sequences,
+    # initialized with MAX(record_id)+1 of the table, so concurrent writers
+    # that all reserve their record_ids here don't collide
+    def allocate_record_ids(self, table, n):
+        if not self._record_id_sequences_created:
+            self.query('CREATE TABLE IF NOT EXISTS `record_id_sequences` ('
+                       '`table_name` VARCHAR(255) NOT NULL PRIMARY KEY, '
+                       '`next_id` BIGINT NOT NULL);').close()
+            self._record_id_sequences_created = True
+        update = ('UPDATE `record_id_sequences` SET `next_id` = `next_id` + %s '
+                  'WHERE `table_name` = %s;')
+        self.begin()
+        try:
+            # the UPDATE locks the row until commit()
+            cur = self.query(update, n, table._name)
+            updated = cur.rowcount
+            cur.close()
+            if updated == 0:
+                self.query('{} INTO `record_id_sequences` '
+                           '(`table_name`, `next_id`) '
+                           'SELECT %s, COALESCE(MAX(`record_id`), 0)+1 '
+                           'FROM {!s};'.format(self.insert_ignore, table),
+                           table._name).close()
+                self.query(update, n, table._name).close()
+            cur = self.query('SELECT `next_id` FROM `record_id_sequences` '
+                             'WHERE `table_name` = %s;', table._name)
+            next_id = cur.fetchone()[0]
+            cur.close()
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        self.logger.debug('reserved record_ids {:d} to {:d} of {}'.format(
+            next_id-n, next_id-1, table._name))
+        return next_id-n
+
+    # indexes: name -> (column1, column2, ...)
+    # returns the indexes that no existing index of the table covers, an
+    # index covers the ones it starts with, e.g. (record_id, id) covers
+    # (record_id)
+    def missing_indexes(self, table, indexes):
+        existing = list(self.get_indexes(table).values())
+        return collections.OrderedDict([
+            (name, columns) for name, columns in indexes.items()
+            if not any(x[:len(columns)] == tuple(columns) for x in existing)])
+
+    # print (or apply in direct mode) CREATE INDEX statements for the missing
+    # indexes of a table (sql.Table), see missing_indexes()
+    def print_index_sql(self, table, indexes):
+        for name, columns in self.missing_indexes(table._name,
+                                                  indexes).items():
+            self.write('CREATE INDEX `{}` ON {!s} ({});'.format(
+                name, table, ', '.join(['`{}`'.format(x) for x in columns])))
+
+    # the query plan: [(table, access, index), ...], access is 'ALL' for a
+    # full table scan
+    def explain(self, *args):
+        if isinstance(args[0], sql.Query): statement, params = tuple(args[0])
+        else: statement, params = args[0], tuple(args[1:])
+        cur = self.query('EXPLAIN ' + statement, *params, dictionary=True)
+        plan = [(x['table'], x['type'], x['key']) for x in cur.fetchall()]
+        cur.close()
+        return plan
+
+    # create an empty table with the columns of template unless it exists
+    def create_table_like(self, table, template):
+        self.query(self.create_table_like_sql(table, template)).close()
+
+    def create_table_like_sql(self, table, template):
+        return 'CREATE TABLE IF NOT EXISTS {} LIKE {};'.format(table, template)
+
+    # forget cached columns of a table (or all tables) of this database,
+    # e.g. after ALTER TABLE
+    def invalidate_columns(self, table=None):
+        invalidate_column_cache(self._name, table)
+
+    # indexes of a table: index name -> (column1, column2, ...)
+    def get_indexes(self, table):
+        statistics = sql.Table('statistics', 'information_schema')
+        q = statistics.select(
+            statistics.index_name, statistics.column_name,
+            where=((statistics.table_schema == self._name) &
+                   (statistics.table_name == table)),
+            order_by=(statistics.index_name.asc, statistics.seq_in_index.asc))
+        cur = self.query(q)
+        indexes = collections.OrderedDict()
+        for index_name, column_name in cur.fetchall():
+            indexes.setdefault(index_name, []).append(column_name)
+        cur.close()
+        return collections.OrderedDict(
+            [(k, tuple(v)) for k, v in indexes.items()])
+
+    # the result is read into a QueryResult and the cursor is closed, so its
+    # connection goes back to the pool right away and the result can be used
+    # in any thread (a cursor given as cursor is used as it is)
+    # failed read-only queries (see _is_read_only()) are retried on a new
+    # connection, except in a transaction. writes are not retried, they may
+    # have been applied before the connection failed
+    # a PreparedQuery (see prepare()) runs on a prepared cursor of the
+    # connection, so the server parses its statement once per connection
+    def query(self, *args, cursor=None, dictionary=False):
+        start = time.perf_counter()
+        reconnects = 0
+        if isinstance(cursor, ProfiledCursor): cursor = cursor.cursor
+        prepared = isinstance(args[0], PreparedQuery)
+        if prepared: args = (args[0].statement,) + args[0].bind(args[1:])
+        while True:
+            conn = None
+            if cursor is None:
+                conn = self._acquire()
+                if prepared:
+                    cur = self._prepared_cursor(conn, args[0], dictionary)
+                else:
+                    cur = conn.cursor(buffered=True, dictionary=dictionary)
             else:
-                self.logger.debug(repr(args))
-                cur.execute(*args)
+                cur = cursor
+            try:
+                if prepared and (cursor is None):
+                    self.logger.debug(repr(args))
+                    cur.execute(args[0], args[1:])
+                    cur = QueryResult(cur)
+                elif cursor is None:
+                    self._execute(cur, args)
+                    result = QueryResult(cur)
+                    cur.close()
+                    cur = result
+                else:
+                    self._execute(cur, args)
+            except (mysql.connector.errors.OperationalError,
+                    mysql.connector.errors.InterfaceError) as e:
+                in_transaction = ((conn is not None) and
+                                  (conn is getattr(self._local, 'conn', None)))
+                if conn is not None: self._discard(conn)
+                if (in_transaction or (reconnects >= self.max_retries) or
+                    (not self._is_read_only(args))): raise
+                delay = self.retry_delay*(2**reconnects)
+                self.logger.warning('query failed ({}), reconnecting in '
+                                    '{:.1f} s'.format(e, delay))
+                time.sleep(delay)
+                reconnects += 1
+                cursor = None
+                continue
+            except Exception:
+                if prepared and (conn is not None):
+                    # the statement is prepared again next time
+                    self._prepared_cursors[conn].pop(
+                        (args[0], dictionary), None)
+                elif (conn is not None) and (cur is not cursor):
+                    cur.close()
+                if conn is not None: self._release(conn)
+                raise
+            if conn is not None: self._release(conn)
+            return self._profiled(cur, args, start, reconnects)
+
+    # compile a python-sql query (or SQL text with %s placeholders and its
+    # params) once, use Parameter as placeholder for the values that change:
+    #   q = DB.prepare(t.select(where=(t.accession == Parameter())))
+    #   for acc in accessions: cur = DB.query(q, acc)
+    # queries of the same shape share one PreparedQuery
+    def prepare(self, query, *params):
+        if isinstance(query, sql.Query): statement, params = tuple(query)
+        else: statement = self.paramstyle(query)
+        key = (statement, tuple([None if isinstance(x, Parameter) else x
+                                 for x in params]))
+        try:
+            return self._prepared[key]
+        except TypeError:
+            return PreparedQuery(statement, params)
+        except KeyError:
+            pass
+        return self._prepared.setdefault(key, PreparedQuery(statement, params))
+
+    # the prepared cursor of a connection for a statement, it keeps the
+    # statement prepared on the server as long as the connection is open
+    def _prepared_cursor(self, conn, statement, dictionary):
+        with self._pool_lock:
+            cursors = self._prepared_cursors.setdefault(conn, dict())
+        cur = cursors.get((statement, dictionary))
+        if cur is None:
+            cur = conn.cursor(prepared=True, dictionary=dictionary)
+            cursors[(statement, dictionary)] = cur
         return cur
 
+    def _execute(self, cur, args):
+        if isinstance(args[0], PreparedQuery):
+            args = (args[0].statement,) + args[0].bind(args[1:])
+        if isinstance(args[0], sql.Query):
+            self.logger.debug(repr(tuple(args[0])))
+            cur.execute(*tuple(args[0]))
+        elif isinstance(args[0], str):
+            self.logger.debug(repr(args))
+            cur.execute(self.paramstyle(args[0]), tuple(args[1:]))
+        else:
+            self.logger.debug(repr(args))
+            cur.execute(*args)
+
+    # iterate over the rows of a query without loading the whole result into
+    # memory, rows are fetched chunk_size at a time from an unbuffered cursor
+    # on a separate connection, so other queries can run while iterating
+    def iterate(self, *args, chunk_size=1000, dictionary=False):
+        conn = self._new_connection(buffered=False, consume_results=True)
+        try:
+            yield from self._iterate(conn.cursor(dictionary=dictionary),
+                                     args, chunk_size)
+        finally:
+            conn.close()
+
+    def _iterate(self, cur, args, chunk_size):
+        start = time.perf_counter()
+        self._execute(cur, args)
+        cur = self._profiled(cur, args, start)
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows: break
+                yield from rows
+        finally:
+            cur.close()
+
+    # the SQL text of the args of query()
+    @staticmethod
+    def _statement(args):
+        if isinstance(args[0], PreparedQuery): return args[0].statement
+        if isinstance(args[0], sql.Query): return tuple(args[0])[0]
+        return str(args[0])
+
+    # True if the statement of the args of query() only reads, so running it
+    # again after a failure does no harm
+    @classmethod
+    def _is_read_only(cls, args):
+        return _read_only_statement.match(cls._statement(args)) is not None
+
+    # wrap the cursor of a query for the profiler, if profiling is enabled
+    def _profiled(self, cur, args, start, reconnects=0):
+        if self.profiler is None: return cur
+        return self.profiler.executed(cur, self._statement(args),
+                                      time.perf_counter()-start,
+                                      reconnects=reconnects)
+
+    @staticmethod
     def escape(s):
         # string escaping
         # https://dev.mysql.com/doc/refman/8.0/en/string-literals.html
@@ -74,62 +954,297 @@ class Database(object):
             '\t': '\\t',
             '\\': '\\\\',
             }))
-    def format(v):
+    # v as an SQL literal, Database.format() for MySQL, DB.format() for the
+    # dialect of DB
+    @classmethod
+    def format(cls, v):
         if isinstance(v, int) or isinstance(v, bool): return '{:d}'.format(v)
         elif isinstance(v, float): return '{}'.format(v)
         elif v is None: return 'NULL'
-        else: return '\'{}\''.format(Database.escape(str(v)))
+        else: return '\'{}\''.format(cls.escape(str(v)))
+    @classmethod
+    def render(cls, statement, params):
+        return statement % tuple([cls.format(x) for x in params])
 
+# a single connection, not shared between threads
 class SQLiteDatabase(Database):
-    def __init__(self, filename):
-        super(SQLiteDatabase, self).__init__(database=filename, host=None, user=None, password=None)
+    conn = None
+    insert_ignore = 'INSERT OR IGNORE'
+    has_user_variables = False
+    export_extension = 'csv'
+    export_loader = 'import.sql'
+    begin_sql = 'BEGIN;'
+    def __init__(self, filename, direct=None, batch_size=1000,
+                 max_allowed_packet=1024*1024, profile=None, export_dir=None):
+        super(SQLiteDatabase, self).__init__(database=filename, host=None, user=None, password=None,
+                                             direct=direct, batch_size=batch_size,
+                                             max_allowed_packet=max_allowed_packet,
+                                             profile=profile, export_dir=export_dir)
         self.logger = logging.getLogger('sqlite')
         sql.Flavor.set(sql.Flavor(paramstyle='qmark'))
+    # the connection may be used by the worker thread of AsyncDatabase
     def connect(self):
-        self.conn = sqlite3.connect(self._name)
-        self.conn.row_factory = sqlite3.Row
+        self.conn = sqlite3.connect(self._name, check_same_thread=False)
+        self.conn.create_function('SUBSTRING_INDEX', 3, _substring_index,
+                                  deterministic=True)
+    def server_version(self):
+        return sqlite3.sqlite_version_info
+    def has_window_functions(self):
+        return self.server_version() >= (3, 25, 0)
+    def commit(self):
+        self.logger.debug('committing records')
+        self.conn.commit()
+    def begin(self):
+        if self.conn.in_transaction: self.conn.commit()
+        self.conn.execute('BEGIN')
+    def rollback(self):
+        self.conn.rollback()
+    def close(self):
+        self.conn.close()
+    def paramstyle(self, statement):
+        return statement.replace('%s', '?')
+    def truncate_sql(self, table):
+        return 'DELETE FROM {!s};'.format(table)
+    # text is compared with the BINARY collation by default
+    def case_sensitive(self, expression):
+        return '{} COLLATE BINARY'.format(expression)
+    # SQLite string literals have no backslash escapes, ' is doubled
+    @staticmethod
+    def escape(s):
+        return s.replace('\'', '\'\'')
+    # CSV for the .import command of the sqlite3 shell, which has no NULL,
+    # so NULL is written as \N and converted by the script
+    def export_line(self, values):
+        line = io.StringIO()
+        csv.writer(line, lineterminator='\n').writerow(
+            ['\\N' if v is None else Database.format(v)
+             if isinstance(v, (int, bool, float)) else v for v in values])
+        return line.getvalue()
+    # run with: sqlite3 database.sqlite <table.import.sql
+    def export_script(self, export):
+        table = export['table']
+        lines = []
+        if export['truncate']:
+            lines.append('DELETE FROM {!s};'.format(table))
+        if export['columns'] is not None:
+            staging = '"{}_import"'.format(table._name.replace('"', '""'))
+            columns = ['"{}"'.format(x.replace('"', '""'))
+                       for x in export['columns']]
+            lines.append('CREATE TEMP TABLE {} ({});'.format(
+                staging, ', '.join(columns)))
+            lines.append(".import --csv '{}' {}".format(export['filename'],
+                                                        staging))
+            lines.append('INSERT INTO {!s} ({}) SELECT {} FROM {};'.format(
+                table, ', '.join(columns),
+                ', '.join(["NULLIF({}, '\\N')".format(x) for x in columns]),
+                staging))
+            lines.append('DROP TABLE {};'.format(staging))
+        return '\n'.join(lines) + '\n'
+    def create_table_like_sql(self, table, template):
+        return 'CREATE TABLE IF NOT EXISTS {} AS SELECT * FROM {} WHERE 0;'.format(
+            table, template)
+    # EXPLAIN QUERY PLAN lines like "SCAN t", "SEARCH t USING INDEX i (...)"
+    def explain(self, *args):
+        if isinstance(args[0], sql.Query): statement, params = tuple(args[0])
+        else: statement, params = args[0], tuple(args[1:])
+        cur = self.query('EXPLAIN QUERY PLAN ' + statement, *params)
+        plan = []
+        for detail in [x[3] for x in cur.fetchall()]:
+            words = detail.split()
+            if words[0] not in ('SCAN', 'SEARCH'): continue
+            # materialized subqueries and constant rows are no tables
+            if (words[1] in ('CONSTANT', 'SUBQUERY') or
+                words[1].startswith('(')): continue
+            index = None
+            if 'INDEX' in words: index = words[words.index('INDEX')+1]
+            access = ('ALL' if (words[0] == 'SCAN') and (index is None)
+                      else words[0].lower())
+            plan.append((words[1], access, index))
+        cur.close()
+        return plan
+    def get_indexes(self, table):
+        indexes = collections.OrderedDict()
+        cur = self.conn.execute('PRAGMA index_list("{}")'.format(
+            table.replace('"', '""')))
+        for index in cur.fetchall():
+            info = self.conn.execute('PRAGMA index_info("{}")'.format(
+                index[1].replace('"', '""')))
+            indexes[index[1]] = tuple([x[2] for x in info.fetchall()])
+            info.close()
+        cur.close()
+        return indexes
+    def _query_columns(self, table):
+        cur = self.conn.execute('PRAGMA table_info("{}")'.format(
+            table.replace('"', '""')))
+        columns = [x[1] for x in cur.fetchall()]
+        cur.close()
+        return columns
+    # sqlite3 cursors fetch rows lazily, so no separate connection is needed
+    def iterate(self, *args, chunk_size=1000, dictionary=False):
+        yield from self._iterate(self.cursor(dictionary), args, chunk_size)
+
+    # rows are tuples, or dicts like those of mysql.connector with
+    # dictionary=True
+    def cursor(self, dictionary=False):
+        cur = self.conn.cursor()
+        if dictionary: cur.row_factory = _dict_row
+        return cur
+
     def query(self, *args, cursor=None, dictionary=False):
-        if cursor is None: cur = self.conn.cursor()
+        start = time.perf_counter()
+        if isinstance(cursor, ProfiledCursor): cursor = cursor.cursor
+        if cursor is None: cur = self.cursor(dictionary)
         else: cur = cursor
-        if isinstance(args[0], sql.Query):
-            self.logger.debug(repr(tuple(args[0])))
-            cur.execute(*tuple(args[0]))
-        elif isinstance(args[0], str):
-            self.logger.debug(repr(args))
-            cur.execute(args[0], tuple(args[1:]))
-        else:
-            self.logger.debug(repr(args))
-            cur.execute(*args)
-        return cur
+        # sqlite3 keeps compiled statements in its statement cache, so a
+        # PreparedQuery only saves the compilation of the python-sql query
+        if isinstance(args[0], PreparedQuery):
+            args = (args[0].statement,) + args[0].bind(args[1:])
+        self._execute(cur, args)
+        return self._profiled(cur, args, start)
+
+def _dict_row(cursor, row):
+    return dict(zip([x[0] for x in cursor.description], row))
+
+# SUBSTRING_INDEX() of MySQL for SQLite
+def _substring_index(s, delimiter, count):
+    if (s is None) or (delimiter is None) or (count is None): return None
+    if delimiter == '' or count == 0: return ''
+    parts = s.split(delimiter)
+    if count > 0: return delimiter.join(parts[:count])
+    return delimiter.join(parts[count:])
+
+# the database of the pipeline, selected by the SLC_DATABASE environment
+# variable: 'sqlite:<file>' or a file name ending in .sqlite, .sqlite3 or
+# .db opens a local SQLite file, 'mysql' or nothing the MySQL server
+# configured in Database
+# kwargs are passed on, e.g. direct=True
+def open_database(database=None, **kwargs):
+    if database is None:
+        database = os.environ.get('SLC_DATABASE') or 'mysql'
+    if database.startswith('sqlite:'):
+        return SQLiteDatabase(database[len('sqlite:'):], **kwargs)
+    if database.endswith(('.sqlite', '.sqlite3', '.db')):
+        return SQLiteDatabase(database, **kwargs)
+    if database != 'mysql':
+        raise ValueError('unknown database {!r} (SLC_DATABASE), use mysql or '
+                         'sqlite:<file>'.format(database))
+    return Database(**kwargs)
+
+# asyncio counterpart of Database.query() for lookups that can't be turned
+# into bulk queries: queries run in a thread pool on the connections of db,
+# so up to concurrency queries (by default pool_size, 1 for SQLite) wait for
+# the server at the same time
+#   adb = AsyncDatabase(DB)
+#   rows = asyncio.run(adb.map(q, accessions, dictionary=True))
+#   for acc, rows in zip(accessions, adb.imap(q, accessions)): ...
+class AsyncDatabase(object):
+    def __init__(self, db, concurrency=None):
+        if concurrency is None:
+            if isinstance(db, SQLiteDatabase): concurrency = 1
+            else: concurrency = db.pool_size
+        self.db = db
+        self.concurrency = concurrency
+        # number of queries map() and imap() submit at a time
+        self.chunk_size = 16*concurrency
+        # python-sql compiles queries with the flavor of the current thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, initializer=sql.Flavor.set,
+            initargs=(sql.Flavor.get(),))
+        # one per event loop (imap() runs one per chunk), see _run()
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    async def _run(self, args, dictionary, fetch):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphores[loop] = semaphore
+        def run():
+            cur = self.db.query(*args, dictionary=dictionary)
+            try:
+                return fetch(cur)
+            finally:
+                cur.close()
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, run)
+
+    # the rows of a query, arguments as for Database.query()
+    async def fetchall(self, *args, dictionary=False):
+        return await self._run(args, dictionary, lambda cur: cur.fetchall())
+
+    # the first row of a query or None
+    async def fetchone(self, *args, dictionary=False):
+        return await self._run(args, dictionary, lambda cur: cur.fetchone())
+
+    # run query (usually a PreparedQuery) once for each value (a tuple of
+    # params or a single param), returns the rows of each run in the order of
+    # values
+    # the queries are submitted chunk_size at a time, so only their tasks are
+    # pending, not one for each value
+    async def map(self, query, values, dictionary=False):
+        rows = []
+        values = iter(values)
+        while True:
+            chunk = list(itertools.islice(values, self.chunk_size))
+            if not chunk: return rows
+            rows.extend(await asyncio.gather(*[
+                self.fetchall(query, *(x if isinstance(x, tuple) else (x,)),
+                              dictionary=dictionary) for x in chunk]))
+
+    # like map(), but called outside of an event loop, yields the rows of each
+    # run as their chunk is done, so only chunk_size results are kept
+    def imap(self, query, values, dictionary=False):
+        values = iter(values)
+        while True:
+            chunk = list(itertools.islice(values, self.chunk_size))
+            if not chunk: return
+            yield from asyncio.run(self.map(query, chunk,
+                                            dictionary=dictionary))
+
+    def close(self):
+        self._executor.shutdown()
 
 from sql.functions import Function
 class Substring_index(Function):
     __slots__ = ()
     _function = 'SUBSTRING_INDEX'
 
+# record_id_block: reserve record_ids in blocks of this size with
+# Database.allocate_record_ids() instead of counting up from MAX(record_id),
+# by default set by the SLC_RECORD_ID_BLOCK environment variable (0: off)
+def _record_id_block(record_id_block):
+    if record_id_block is None:
+        record_id_block = int(os.environ.get('SLC_RECORD_ID_BLOCK') or '0')
+    return record_id_block
+
 class Table(sql.Table):
     # "database" in the next line is not the same as schema
-    def __init__(self, name, db, database=None, explicit_record_ids=True):
+    # record_id_block: see _record_id_block()
+    def __init__(self, name, db, database=None, explicit_record_ids=True,
+                 record_id_block=None):
         super(Table, self).__init__(name, None, database)
         self._last_record_id = None
+        self._record_id_block = _record_id_block(record_id_block)
+        # last record_id of the reserved block
+        self._record_id_block_end = None
         # check if we have a record_id and a manual field
-        info_schema = sql.Table('columns', 'information_schema')
-        q = info_schema.select(
-            info_schema.column_name,
-            where=((info_schema.table_schema == db._name) &
-                   (info_schema.table_name == name)))
-        cur = db.query(q)
-        self._has_record_id = False
-        self._has_manual = False
-        for row in cur.fetchall():
-            if row[0] == 'record_id': self._has_record_id = True
-            elif row[0] == 'manual': self._has_manual = True
-        cur.close()
+        columns = db.get_columns(name)
+        self._has_record_id = ('record_id' in columns)
+        self._has_manual = ('manual' in columns)
         self._explicit_record_ids = explicit_record_ids
         self._db = db
 
     def get_next_record_id(self):
         if not self._has_record_id: return None
+        if self._record_id_block:
+            if ((self._last_record_id is None) or
+                (self._last_record_id >= self._record_id_block_end)):
+                first = self._db.allocate_record_ids(self,
+                                                     self._record_id_block)
+                self._last_record_id = first-1
+                self._record_id_block_end = first-1 + self._record_id_block
+            self._last_record_id += 1
+            return self._last_record_id
         if self._last_record_id is not None:
             record_id = self._last_record_id
         else:
@@ -147,61 +1262,102 @@ class Table(sql.Table):
         if isinstance(row, dict):
             for key in row.keys():
                 keys.append('`{}`'.format(Database.escape(key)))
-                values.append(Database.format(row[key]))
+                values.append(row[key])
         elif isinstance(row, list) or isinstance(row, tuple):
             for key, value in row:
                 keys.append('`{}`'.format(Database.escape(key)))
-                values.append(Database.format(row[key]))
+                values.append(value)
         if keys:
             if user is not None:
                 keys.append('`user`')
-                values.append(Database.format(user))
+                values.append(user)
             if isinstance(comments, list) or isinstance(comments, tuple):
                 keys.append('`comments`')
-                values.append(Database.format('\n'.join(comments)))
+                values.append('\n'.join(comments))
             elif isinstance(comments, str):
                 keys.append('`comments`')
-                values.append(Database.format(comments))
+                values.append(comments)
+            # SQL expressions of values, '%s' is a parameter
+            placeholders = ['%s']*len(values)
+            prologue = None
             if self._has_manual and (manual is not None):
                 keys.insert(0, '`manual`')
-                values.insert(0, '{:d}'.format(manual))
+                values.insert(0, int(manual))
+                placeholders.insert(0, '%s')
+            exporting = (self._db.export_dir is not None)
             if self._has_record_id:
                 keys.insert(0, '`record_id`')
-                if self._explicit_record_ids:
-                    values.insert(0, '{:d}'.format(self.get_next_record_id()))
+                if (self._explicit_record_ids or self._record_id_block or
+                    exporting or not self._db.has_user_variables):
+                    values.insert(0, self.get_next_record_id())
+                    placeholders.insert(0, '%s')
                 else:
-                    values.insert(0, '@next_record_id')
-                    print('SELECT MAX(`record_id`)+1 INTO @next_record_id '
-                          'FROM {};'.format(Database.escape(str(self))))
-            print('INSERT INTO {} ({}) VALUES ({});'.format(
-                Database.escape(str(self)),
-                ', '.join(keys),
-                ', '.join(values)
-            ))
+                    placeholders.insert(0, '@next_record_id{offset}')
+                    prologue = ('SELECT MAX(`record_id`)+1 INTO @next_record_id '
+                                'FROM {};'.format(Database.escape(str(self))))
+            if exporting:
+                # keys are `quoted` column names
+                self._db.export_row(self, [x[1:-1] for x in keys], values)
+                return
+            self._db.write_insert(Database.escape(str(self)), keys,
+                                  '({})'.format(', '.join(placeholders)),
+                                  values, prologue=prologue)
+
+    def print_truncate_sql(self):
+        if self._db.export_dir is not None:
+            self._db.export_truncate(self)
+            return
+        self._db.write(self._db.truncate_sql(self))
 
 class HistoryTable(sql.Table):
+    # snapshot: read from the materialized snapshot <name>_current instead
+    # of <name>, call refresh_snapshot() to bring it up to date
+    # record_id_block: see _record_id_block()
     def __init__(self, name, db, schema=None, database=None,
-                 explicit_record_ids=True):
-        super(HistoryTable, self).__init__(name, schema, database)
+                 explicit_record_ids=True, snapshot=False,
+                 record_id_block=None):
+        super(HistoryTable, self).__init__(
+            name + '_current' if snapshot else name, schema, database)
         self._history = sql.Table(name + '_history', schema, database)
+        self._snapshot = sql.Table(name + '_current', schema, database)
+        self._reads_snapshot = snapshot
         self._last_record_id = None
+        self._record_id_block = _record_id_block(record_id_block)
+        # last record_id of the reserved block
+        self._record_id_block_end = None
         # check if we have a manual field
         # record_id is mandatory here
-        info_schema = sql.Table('columns', 'information_schema')
-        q = info_schema.select(
-            info_schema.column_name,
-            where=((info_schema.table_schema == db._name) &
-                   (info_schema.table_name == name)))
-        cur = db.query(q)
         self._has_record_id = True
-        self._has_manual = False
-        for row in cur.fetchall():
-            if row[0] == 'manual': self._has_manual = True
-        cur.close()
+        self._has_manual = ('manual' in db.get_columns(name))
         self._explicit_record_ids = explicit_record_ids
         self._db = db
+        # history versions loaded by prefetch_history()
+        #   record_id -> [version1, version2, ...] (ordered by id)
+        self._versions = dict()
+        #   (key_name, key_value) -> [record_id1, record_id2, ...]
+        self._key_record_ids = dict()
+        #   id of a prefetched version -> record_id, see _forget_record()
+        self._version_record_ids = dict()
+        # number of keys put in one IN (...) clause by the bulk lookups
+        self.bulk_chunk_size = 1000
+        # history ids before the last refresh checked again, see
+        # refresh_snapshot()
+        self.snapshot_overlap = 10000
+        # see _use_window_functions()
+        self.diff_engine = None
+        # columns of the history table except id, see print_update_sql()
+        self._history_columns = None
 
     def get_next_record_id(self):
+        if self._record_id_block:
+            if ((self._last_record_id is None) or
+                (self._last_record_id >= self._record_id_block_end)):
+                first = self._db.allocate_record_ids(self._history,
+                                                     self._record_id_block)
+                self._last_record_id = first-1
+                self._record_id_block_end = first-1 + self._record_id_block
+            self._last_record_id += 1
+            return self._last_record_id
         if self._last_record_id is not None:
             record_id = self._last_record_id
         else:
@@ -219,59 +1375,313 @@ class HistoryTable(sql.Table):
         if isinstance(row, dict):
             for key in row.keys():
                 keys.append('`{}`'.format(Database.escape(key)))
-                values.append(Database.format(row[key]))
+                values.append(row[key])
         elif isinstance(row, list) or isinstance(row, tuple):
             for key, value in row:
                 keys.append('`{}`'.format(Database.escape(key)))
-                values.append(Database.format(row[key]))
+                values.append(value)
         if keys:
+            # the new record belongs to the prefetched keys of its values
+            for key, value in zip(keys, values):
+                self._key_record_ids.pop((key[1:-1], value), None)
             if user is not None:
                 keys.append('`user`')
-                values.append(Database.format(user))
+                values.append(user)
             if isinstance(comments, list) or isinstance(comments, tuple):
                 keys.append('`comments`')
-                values.append(Database.format('\n'.join(comments)))
+                values.append('\n'.join(comments))
             elif isinstance(comments, str):
                 keys.append('`comments`')
-                values.append(Database.format(comments))
+                values.append(comments)
+            # SQL expressions of values, '%s' is a parameter
+            placeholders = ['%s']*len(values)
+            prologue = None
             if self._has_manual:
                 keys.insert(0, '`manual`')
-                values.insert(0, '{:d}'.format(manual))
+                values.insert(0, int(manual))
+                placeholders.insert(0, '%s')
             keys.insert(0, '`record_id`')
-            if self._explicit_record_ids:
-                values.insert(0, '{:d}'.format(self.get_next_record_id()))
+            if (self._explicit_record_ids or self._record_id_block or
+                not self._db.has_user_variables):
+                values.insert(0, self.get_next_record_id())
+                placeholders.insert(0, '%s')
             else:
-                values.insert(0, '@next_record_id')
-                print('SELECT MAX(`record_id`)+1 INTO @next_record_id '
-                      'FROM {};'.format(Database.escape(str(self._history))))
-            print('INSERT INTO {} ({}) VALUES ({});'.format(
-                Database.escape(str(self._history)),
-                ', '.join(keys),
-                ', '.join(values)
-            ))
+                placeholders.insert(0, '@next_record_id{offset}')
+                prologue = ('SELECT MAX(`record_id`)+1 INTO @next_record_id '
+                            'FROM {};'.format(Database.escape(str(self._history))))
+            self._db.write_insert(Database.escape(str(self._history)), keys,
+                                  '({})'.format(', '.join(placeholders)),
+                                  values, prologue=prologue)
 
+    # a new version of the history row _id, written as a single
+    #   INSERT INTO x_history (...) SELECT ... FROM x_history WHERE id = _id
+    # consecutive printed updates are combined into one statement, see
+    # Database.write_insert_select()
+    # the timestamp is not copied, the new version gets the default of the
+    # column (the current time), so as_of() can rely on ids and timestamps
+    # increasing together
     def print_update_sql(self, _id, values, manual=0, user=None, comments=None):
-        # write sql query
-        print('CREATE TEMPORARY TABLE `tmptable` '
-              'SELECT * FROM {} WHERE `id` = {:d}; '
-              'UPDATE `tmptable` '
-              'SET `id` = NULL;'.format(str(self._history), _id))
-        # modify
+        c = None
         if isinstance(comments, list) or isinstance(comments, tuple):
-            c = Database.format('\n'.join(comments))
+            c = '\n'.join(comments)
         elif isinstance(comments, str):
-            c = Database.format(comments)
-        print('UPDATE `tmptable` '
-              'SET `user` = {}, '
-              '`comments` = {};'.format(Database.format(user), c))
-        if self._has_manual:
-            print('UPDATE `tmptable` SET `manual` = {:d};'.format(manual))
-        for key, value in values.items():
-            print('UPDATE `tmptable` SET `{}` = {};'.format(
-                Database.escape(key), Database.format(value)))
-        print('INSERT INTO {} SELECT * FROM `tmptable`; '
-              'DROP TEMPORARY TABLE IF EXISTS '
-              '`tmptable`;'.format(str(self._history)))
+            c = comments
+        overrides = dict(values)
+        overrides['user'] = user
+        overrides['comments'] = c
+        if self._has_manual: overrides['manual'] = int(manual)
+        self._forget_record(self._version_record_ids.get(_id), values)
+        if self._history_columns is None:
+            self._history_columns = [x for x in
+                                     self._db.get_columns(self._history._name)
+                                     if x != 'id']
+        unknown = set(overrides) - set(self._history_columns)
+        if unknown:
+            raise KeyError('unknown column(s) {!r} in table {!s}'.format(
+                sorted(unknown), self._history))
+        columns = [x for x in self._history_columns
+                   if (x != 'timestamp') or (x in overrides)]
+        self._db.write_insert_select(
+            str(self._history),
+            ['`{}`'.format(Database.escape(x)) for x in columns],
+            'SELECT {} FROM {!s} WHERE `id` = %s'.format(
+                ', '.join(['%s' if x in overrides else
+                           '`{}`'.format(Database.escape(x))
+                           for x in columns]),
+                self._history),
+            [overrides[x] for x in columns if x in overrides] +
+            [_id], source=_id)
+
+    # the snapshot table <name>_current holds the latest version of each
+    # record that is not deleted, like the current-state table <name>.
+    # it is refreshed incrementally: only records with history rows newer
+    # than the last refresh (kept in the table history_snapshots), or within
+    # the last snapshot_overlap ids before it, are checked, and those whose
+    # latest version differs from the snapshot are replaced. the overlap
+    # catches versions that were committed after a refresh although their
+    # ids are lower than its last id.
+    # full: rebuild the snapshot from scratch, e.g. after the structure of
+    # the history table has changed
+    # the snapshot is a cache, so it is written immediately, even if the
+    # database is not in direct mode
+    def refresh_snapshot(self, full=False):
+        self._db.query('CREATE TABLE IF NOT EXISTS `history_snapshots` ('
+                       '`table_name` VARCHAR(255) NOT NULL PRIMARY KEY, '
+                       '`last_id` BIGINT NOT NULL);').close()
+        if full:
+            self._db.query('DROP TABLE IF EXISTS {!s};'.format(
+                self._snapshot)).close()
+            self._db.query('DELETE FROM `history_snapshots` '
+                           'WHERE `table_name` = %s;',
+                           self._history._name).close()
+        self._db.create_table_like(str(self._snapshot), str(self._history))
+        self._db.begin()
+        try:
+            # read in the transaction, so the snapshot matches max_id
+            cur = self._db.query('SELECT `last_id` FROM `history_snapshots` '
+                                 'WHERE `table_name` = %s;',
+                                 self._history._name)
+            row = cur.fetchone()
+            cur.close()
+            last_id = 0 if row is None else row[0]
+            cur = self._db.query('SELECT MAX(`id`) FROM {!s};'.format(
+                self._history))
+            max_id = cur.fetchone()[0] or 0
+            cur.close()
+            lo = max(last_id - self.snapshot_overlap, 0)
+            # records whose latest version up to max_id isn't in the snapshot
+            cur = self._db.query(
+                'SELECT h.`record_id` FROM {history} AS h '
+                'JOIN (SELECT MAX(`id`) AS `id` FROM {history} '
+                'WHERE `id` > %s AND `id` <= %s GROUP BY `record_id`) AS l '
+                'ON h.`id` = l.`id` '
+                'LEFT JOIN {snapshot} AS s ON s.`record_id` = h.`record_id` '
+                'WHERE (h.`deleted` = 0 AND '
+                '(s.`id` IS NULL OR s.`id` != h.`id`)) OR '
+                '(h.`deleted` != 0 AND s.`id` IS NOT NULL);'.format(
+                    snapshot=self._snapshot, history=self._history),
+                lo, max_id)
+            record_ids = [x[0] for x in cur.fetchall()]
+            cur.close()
+            for i in range(0, len(record_ids), self.bulk_chunk_size):
+                in_list = ', '.join(['{:d}'.format(x) for x in
+                                     record_ids[i:i+self.bulk_chunk_size]])
+                self._db.query(
+                    'DELETE FROM {!s} WHERE `record_id` IN ({});'.format(
+                        self._snapshot, in_list)).close()
+                self._db.query(
+                    'INSERT INTO {snapshot} SELECT h.* FROM {history} AS h '
+                    'JOIN (SELECT MAX(`id`) AS `id` FROM {history} '
+                    'WHERE `record_id` IN ({in_list}) AND `id` <= %s '
+                    'GROUP BY `record_id`) AS l '
+                    'ON h.`id` = l.`id` WHERE h.`deleted` = 0;'.format(
+                        snapshot=self._snapshot, history=self._history,
+                        in_list=in_list),
+                    max_id).close()
+            if max_id > last_id:
+                self._db.query('REPLACE INTO `history_snapshots` '
+                               '(`table_name`, `last_id`) VALUES (%s, %s);',
+                               self._history._name, max_id).close()
+            self._db.commit()
+        except Exception:
+            self._db.rollback()
+            raise
+        if record_ids:
+            logging.info('refreshed {:d} records of snapshot {!s} up to '
+                         'history row {:d}'.format(len(record_ids),
+                                                   self._snapshot, max_id))
+        else:
+            logging.debug('snapshot {!s} is up to date'.format(self._snapshot))
+
+    # the history id up to which the rows read through this table are
+    # current: MAX(id) of the history table, or for a snapshot the last id of
+    # its latest refresh (0 if it has never been refreshed)
+    def current_until(self):
+        if self._reads_snapshot:
+            cur = self._db.query('SELECT `last_id` FROM `history_snapshots` '
+                                 'WHERE `table_name` = %s;',
+                                 self._history._name)
+        else:
+            cur = self._db.query('SELECT MAX(`id`) FROM {!s};'.format(
+                self._history))
+        row = cur.fetchone()
+        cur.close()
+        return (row[0] if row is not None else None) or 0
+
+    # the state of the table at an earlier point: the latest version of each
+    # record up to history id point (int), or up to timestamp point
+    # (datetime or 'YYYY-MM-DD hh:mm:ss'), without deleted records
+    # returns a query with the columns of the history table, which can be
+    # used like the table itself, e.g.
+    #   state = slc_like.as_of('2021-01-01')
+    #   q = state.select(state.accession, where=(state.status > 0))
+    # see index_definitions() for the indexes this needs
+    def as_of(self, point):
+        h = self._history
+        latest = sql.Table(h._name, h._schema, h._database)
+        if isinstance(point, int):
+            until = point
+        else:
+            # ids and timestamps increase together (print_update_sql()
+            # doesn't copy the timestamp), the last id up to the timestamp
+            # is found with the timestamp index
+            stamps = sql.Table(h._name, h._schema, h._database)
+            until = stamps.select(sql.aggregate.Max(stamps.id),
+                                  where=(stamps.timestamp <= point))
+        q_latest = latest.select(sql.aggregate.Max(latest.id).as_('id'),
+                                 where=(latest.id <= until),
+                                 group_by=latest.record_id)
+        versions = sql.Table(h._name, h._schema, h._database)
+        columns = [sql.Column(versions, x) for x in
+                   self._db.get_columns(h._name)]
+        return versions.join(
+            q_latest, condition=(versions.id == q_latest.id)).select(
+                *columns, where=(versions.deleted == 0))
+
+    # ids of the versions of a record (ordered by id) that the policies of
+    # update_row() and update_one_to_many() don't need: for each column, the
+    # last automatic change event (a change of the column or of "deleted")
+    # and everything after it is needed, the oldest of these events E and
+    # the version before E (so E is still a change) are kept. of the older
+    # versions, the automatic ones are superseded and manual ones are kept.
+    # the older values can't be re-used by update_one_to_many() any more.
+    def superseded_versions(self, versions):
+        columns = [x for x in versions[0].keys() if x not in
+                   ('id', 'record_id', 'manual', 'deleted', 'timestamp',
+                    'user', 'comments')]
+        oldest = None
+        for column in columns or ['deleted']:
+            for change in self._changes_from_versions(column, versions):
+                if change['manual'] == 0:
+                    if (oldest is None) or (change['id'] < oldest):
+                        oldest = change['id']
+                    break
+        if oldest is None: return []
+        ids = [x['id'] for x in versions]
+        boundary = ids[max(ids.index(oldest)-1, 0)]
+        return [x['id'] for x in versions if (x['id'] < boundary) and
+                (not self._has_manual or (x['manual'] == 0))]
+
+    # move superseded versions (see superseded_versions()) older than before
+    # (history id or timestamp, like as_of()) from the history table to the
+    # archive table <name>_history_archive
+    # the SQL is printed (or executed in direct mode) in chunks of
+    # bulk_chunk_size records, each archived and deleted in one transaction
+    # (see Database.write_together())
+    # returns the number of archived versions
+    def print_compact_sql(self, before):
+        h = self._history
+        if isinstance(before, int):
+            limit = before
+        else:
+            # the first id after the cutoff, ids and timestamps increase
+            # together, see as_of()
+            cur = self._db.query('SELECT MAX(`id`) FROM {!s} '
+                                 'WHERE `timestamp` < %s;'.format(h), before)
+            limit = cur.fetchone()[0]
+            cur.close()
+            if limit is None: return 0
+            limit += 1
+        archive = sql.Table(h._name + '_archive', h._schema, h._database)
+        cur = self._db.query('SELECT DISTINCT `record_id` FROM {!s} '
+                             'WHERE `id` < %s;'.format(h), limit)
+        record_ids = [x[0] for x in cur.fetchall()]
+        cur.close()
+        self._db.write(self._db.create_table_like_sql(str(archive), str(h)))
+        n_archived = 0
+        n_versions = 0
+        for i in range(0, len(record_ids), self.bulk_chunk_size):
+            versions = self._fetch_versions(
+                'record_id', record_ids[i:i+self.bulk_chunk_size])
+            ids = []
+            for v in versions.values():
+                n_versions += len(v)
+                ids.extend([x for x in self.superseded_versions(v)
+                            if x < limit])
+            for j in range(0, len(ids), self.bulk_chunk_size):
+                in_list = ', '.join(['{:d}'.format(x) for x in
+                                     ids[j:j+self.bulk_chunk_size]])
+                self._db.write_together([
+                    ('INSERT INTO {!s} SELECT * FROM {!s} '
+                     'WHERE `id` IN ({});'.format(archive, h, in_list), ()),
+                    ('DELETE FROM {!s} WHERE `id` IN ({});'.format(
+                        h, in_list), ())])
+            n_archived += len(ids)
+        logging.info('archiving {:d} of {:d} versions of {:d} records in '
+                     '{!s}'.format(n_archived, n_versions, len(record_ids), h))
+        return n_archived
+
+    # indexes of the history table used by as_of(), get_field_changes() and
+    # refresh_snapshot(): name -> (column1, column2, ...)
+    # key_fields: other columns records are looked up by, e.g. 'accession'
+    # in prefetch_history(), sync_rows() and update_one_to_many()
+    def index_definitions(self, key_fields=()):
+        indexes = collections.OrderedDict([
+            ('{}_record_id_id'.format(self._history._name),
+             ('record_id', 'id')),
+            ('{}_timestamp'.format(self._history._name),
+             ('timestamp',)),
+        ])
+        for key in key_fields:
+            indexes['{}_{}'.format(self._history._name, key)] = (key,)
+        return indexes
+
+    # print (or apply in direct mode) CREATE INDEX statements for the
+    # indexes of index_definitions() that the history table does not have
+    # yet, see Database.print_index_sql()
+    def print_index_sql(self, key_fields=()):
+        self._db.print_index_sql(self._history,
+                                 self.index_definitions(key_fields))
+
+    # the SQL backend of get_field_changes(): 'window' uses LAG() (MySQL 8,
+    # MariaDB 10.2, SQLite 3.25), 'subquery' the correlated MAX(id) subquery,
+    # None picks the first one if the server supports window functions
+    def _use_window_functions(self):
+        if self.diff_engine is None:
+            return self._db.has_window_functions()
+        elif self.diff_engine in ('window', 'subquery'):
+            return self.diff_engine == 'window'
+        raise ValueError('unknown diff engine {!r}'.format(self.diff_engine))
 
     """
         db: Database() instance
@@ -280,50 +1690,12 @@ class HistoryTable(sql.Table):
         key: dict -> {field: value} will be used to index history_table
     """
     def get_field_changes(self, fields, key):
-        cond = lambda table: ' AND '.join(
-            ['{!s}.`{!s}` = {}'.format(table, k, Database.format(v))
-             for k, v in key.items()])
-        select_fields = []
-        changed_conds = []
-        if isinstance(fields, str):
-            select_fields.append("t2.`{!s}` AS old_value".format(fields))
-            select_fields.append("t1.`{!s}` AS new_value".format(fields))
-            changed_conds.append("(BINARY t1.`{0!s}` != t2.`{0!s}`)".format(fields))
-        elif isinstance(fields, collections.abc.Iterable):
-            for i, field in enumerate(fields):
-                select_fields.append("t2.`{!s}` AS old_value{:d}".format(field, i+1))
-                select_fields.append("t1.`{!s}` AS new_value{:d}".format(field, i+1))
-                changed_conds.append("(BINARY t1.`{0!s}` != t2.`{0!s}`)".format(field))
-        else:
-            TypeError('"fields" needs to be string or iterable')
-        changed_conds.append('(t1.`deleted` != t2.`deleted`)')
-        ## TODO: make the "manual" field optional based on self._has_manual
-        q = """\
-            SELECT
-                t1.id,
-                t1.record_id,
-                {fields},
-                t1.manual,
-                t1.deleted,
-                t1.timestamp,
-                IFNULL({conditions}, 1) AS changed
-            FROM {table} AS t1
-            LEFT JOIN {table} AS t2
-            ON t2.id = (
-                SELECT
-                    MAX(t3.id)
-                FROM {table} AS t3
-                WHERE ({cond_t3}) AND (t3.id < t1.id)
-                )
-            WHERE {cond_t1}
-            HAVING changed = 1
-            ORDER BY t1.id DESC;""".format(
-                table=str(self._history),
-                fields=', '.join(select_fields),
-                conditions=' OR '.join(changed_conds),
-                cond_t1=cond('t1'),
-                cond_t3=cond('t3'))
-        cur = self._db.query(q, dictionary=True)
+        if list(key.keys()) == ['record_id']:
+            versions = self._cached_versions(key['record_id'], fields)
+            if versions is not None:
+                return self._changes_from_versions(fields, versions)
+        cur = self._db.query(self.field_changes_sql(fields, key),
+                             dictionary=True)
 
         #cur = self._db.query("""\
         #               SELECT
@@ -364,6 +1736,220 @@ class HistoryTable(sql.Table):
                     del change['new_value{:d}'.format(x)]
         return changes
 
+    # the SQL of get_field_changes()
+    def field_changes_sql(self, fields, key):
+        cond = lambda table: ' AND '.join(
+            ['{!s}.`{!s}` = {}'.format(table, k, self._db.format(v))
+             for k, v in key.items()])
+        use_window = self._use_window_functions()
+        if use_window:
+            # the previous version within the same key is the previous row of
+            # the partition, this avoids the correlated MAX(t3.id) subquery
+            window = 'OVER (PARTITION BY {} ORDER BY t1.id)'.format(
+                ', '.join(['t1.`{!s}`'.format(k) for k in key.keys()]))
+            prev = lambda f: 'LAG(t1.`{!s}`) {}'.format(f, window)
+        else:
+            prev = lambda f: 't2.`{!s}`'.format(f)
+        select_fields = []
+        changed_conds = []
+        if isinstance(fields, str):
+            select_fields.append("{} AS old_value".format(prev(fields)))
+            select_fields.append("t1.`{!s}` AS new_value".format(fields))
+            changed_conds.append("({} != {})".format(
+                self._db.case_sensitive('t1.`{!s}`'.format(fields)),
+                prev(fields)))
+        elif isinstance(fields, collections.abc.Iterable):
+            for i, field in enumerate(fields):
+                select_fields.append("{} AS old_value{:d}".format(prev(field), i+1))
+                select_fields.append("t1.`{!s}` AS new_value{:d}".format(field, i+1))
+                changed_conds.append("({} != {})".format(
+                    self._db.case_sensitive('t1.`{!s}`'.format(field)),
+                    prev(field)))
+        else:
+            TypeError('"fields" needs to be string or iterable')
+        changed_conds.append('(t1.`deleted` != {})'.format(prev('deleted')))
+        ## TODO: make the "manual" field optional based on self._has_manual
+        if use_window:
+            q = """\
+                SELECT * FROM (
+                    SELECT
+                        t1.id,
+                        t1.record_id,
+                        {fields},
+                        t1.manual,
+                        t1.deleted,
+                        t1.timestamp,
+                        IFNULL({conditions}, 1) AS changed
+                    FROM {table} AS t1
+                    WHERE {cond_t1}
+                    ) AS t
+                WHERE changed = 1
+                ORDER BY id DESC;""".format(
+                    table=str(self._history),
+                    fields=', '.join(select_fields),
+                    conditions=' OR '.join(changed_conds),
+                    cond_t1=cond('t1'))
+        else:
+            # changed is filtered outside, HAVING without GROUP BY is MySQL
+            # only
+            q = """\
+                SELECT * FROM (
+                    SELECT
+                        t1.id,
+                        t1.record_id,
+                        {fields},
+                        t1.manual,
+                        t1.deleted,
+                        t1.timestamp,
+                        IFNULL({conditions}, 1) AS changed
+                    FROM {table} AS t1
+                    LEFT JOIN {table} AS t2
+                    ON t2.id = (
+                        SELECT
+                            MAX(t3.id)
+                        FROM {table} AS t3
+                        WHERE ({cond_t3}) AND (t3.id < t1.id)
+                        )
+                    WHERE {cond_t1}
+                    ) AS t
+                WHERE changed = 1
+                ORDER BY id DESC;""".format(
+                    table=str(self._history),
+                    fields=', '.join(select_fields),
+                    conditions=' OR '.join(changed_conds),
+                    cond_t1=cond('t1'),
+                    cond_t3=cond('t3'))
+        return q
+
+    # select all versions of the records having key_name in key_values,
+    # one query per bulk_chunk_size keys
+    # returns {record_id: [version1, version2, ...]}, versions ordered by id
+    def _fetch_versions(self, key_name, key_values, fields=None):
+        key_values = list(key_values)
+        versions = dict()
+        for i in range(0, len(key_values), self.bulk_chunk_size):
+            q = self.versions_sql(key_name,
+                                  key_values[i:i+self.bulk_chunk_size],
+                                  fields)
+            cur = self._db.query(q, dictionary=True)
+            for row in cur.fetchall():
+                row = dict(row)
+                versions.setdefault(row['record_id'], []).append(row)
+            cur.close()
+        return versions
+
+    # the SQL of one chunk of _fetch_versions()
+    def versions_sql(self, key_name, key_values, fields=None):
+        if fields is None: columns = '*'
+        else:
+            if isinstance(fields, str): fields = [fields]
+            columns = ['id', 'record_id', 'deleted', 'timestamp', key_name]
+            if self._has_manual: columns.append('manual')
+            columns.extend([x for x in fields if x not in columns])
+            columns = ', '.join(['`{}`'.format(Database.escape(x))
+                                 for x in columns])
+        in_list = ', '.join([self._db.format(x) for x in key_values])
+        if key_name == 'record_id':
+            cond = '`record_id` IN ({})'.format(in_list)
+        else:
+            # a record belongs to the key if any of its versions does,
+            # see update_one_to_many()
+            cond = ('`record_id` IN (SELECT `record_id` FROM {!s} '
+                    'WHERE `{}` IN ({}))'.format(
+                        self._history, Database.escape(key_name), in_list))
+        return 'SELECT {} FROM {!s} WHERE {} ORDER BY `id`;'.format(
+            columns, self._history, cond)
+
+    # the python equivalent of the SQL in get_field_changes() working on the
+    # versions of a single record: a version is a change if it is the first
+    # one or if any of the fields or "deleted" differ from the previous
+    # version (NULL on any side counts as a difference, like IFNULL(..., 1))
+    def _changes_from_versions(self, fields, versions):
+        if isinstance(fields, str): fs = [fields]
+        elif isinstance(fields, collections.abc.Iterable): fs = list(fields)
+        else:
+            raise TypeError('"fields" needs to be string or iterable')
+        differ = lambda a, b: (a is None) or (b is None) or (a != b)
+        changes = []
+        prev = None
+        for version in versions:
+            if ((prev is None) or
+                any(differ(prev[x], version[x]) for x in fs + ['deleted'])):
+                old_value = tuple(None if prev is None else prev[x]
+                                  for x in fs)
+                new_value = tuple(version[x] for x in fs)
+                if isinstance(fields, str):
+                    old_value, new_value = old_value[0], new_value[0]
+                changes.append({
+                    'id': version['id'],
+                    'record_id': version['record_id'],
+                    'old_value': old_value,
+                    'new_value': new_value,
+                    'manual': version['manual'] if self._has_manual else 0,
+                    'deleted': version['deleted'],
+                    'timestamp': version['timestamp'],
+                    'changed': 1})
+            prev = version
+        changes.reverse()
+        return changes
+
+    """
+        fields: string or list (iterable), see get_field_changes
+        key_name: string, name of the field to look up, e.g. 'record_id' or
+            'accession'
+        key_values: iterable of values of key_name
+        returns {record_id: changes} where changes is the same list that
+        get_field_changes(fields, {'record_id': record_id}) would return
+    """
+    def get_field_changes_many(self, fields, key_name, key_values):
+        versions = self._fetch_versions(key_name, key_values, fields)
+        return dict([(record_id, self._changes_from_versions(fields, v))
+                     for record_id, v in versions.items()])
+
+    # load the history of many records at once, so that get_field_changes(),
+    # update_row() and update_one_to_many() don't have to query the database
+    # for each record (and field) separately
+    # fields: columns to load (None = all), only lookups of these fields will
+    # be served from memory
+    def prefetch_history(self, key_name, key_values, fields=None):
+        key_values = set(key_values)
+        versions = self._fetch_versions(key_name, key_values, fields)
+        for key_value in key_values:
+            self._key_record_ids[(key_name, key_value)] = []
+        matches = []
+        for record_id, v in versions.items():
+            self._versions[record_id] = v
+            for version in v:
+                self._version_record_ids[version['id']] = record_id
+                if version[key_name] in key_values:
+                    matches.append((version['id'], version[key_name],
+                                    record_id))
+        # same order as SELECT DISTINCT `record_id` in update_one_to_many()
+        for _id, key_value, record_id in sorted(matches):
+            if record_id not in self._key_record_ids[(key_name, key_value)]:
+                self._key_record_ids[(key_name, key_value)].append(record_id)
+        logging.debug('prefetched {:d} versions of {:d} records from '
+                      '{!s}'.format(sum([len(x) for x in versions.values()]),
+                                    len(versions), self._history))
+
+    # drop the prefetched history of a record that gets a new version, and
+    # the prefetched keys whose records may change with values (a dict of
+    # the changed columns), so later lookups read them from the database
+    def _forget_record(self, record_id, values):
+        versions = self._versions.pop(record_id, None)
+        for key, value in values.items():
+            self._key_record_ids.pop((key, value), None)
+            if versions and (key in versions[-1]):
+                self._key_record_ids.pop((key, versions[-1][key]), None)
+
+    # prefetched versions of record_id if they contain all fields, or None
+    def _cached_versions(self, record_id, fields):
+        if isinstance(fields, str): fields = [fields]
+        versions = self._versions.get(record_id)
+        if versions and all(x in versions[0] for x in fields):
+            return versions
+        return None
+
     def insert_row(self, new_row, manual=0, keys=None, user=None,
                    comments=None):
         if keys is None: keys = new_row.keys()
@@ -392,10 +1978,18 @@ class HistoryTable(sql.Table):
         # set manually
         # POLICY HERE: we don't revert to the last automatic value if the most
         # recent changes were manual.
+        # all versions of the record are needed only once for all fields
+        versions = None
+        if changed_fields:
+            versions = self._cached_versions(old_row['record_id'],
+                                             changed_fields)
+            if versions is None:
+                versions = self._fetch_versions(
+                    'record_id', [old_row['record_id']],
+                    changed_fields).get(old_row['record_id'], [])
         for field in changed_fields[:]:
             # get a list of change events
-            changes = self.get_field_changes(field, {'record_id':
-                                                     old_row['record_id']})
+            changes = self._changes_from_versions(field, versions)
 
             # look for last automatic change
             for change in changes:
@@ -438,23 +2032,36 @@ class HistoryTable(sql.Table):
         #cond = lambda table: ' AND '.join(
         #    ['{!s}.`{}` = {}'.format(table, k, Database.format(v))
         #     for k, v in key.items()])
-        q = ('SELECT DISTINCT `record_id` FROM {!s} '
-             'WHERE {}'.format(
-                 self._history, ' AND '.join(
-                     ['{!s}.`{}` = {}'.format(str(self._history), k, Database.format(v))
-                      for k, v in key.items()])))
-        cur = self._db.query(q)
-        record_ids = [x[0] for x in cur.fetchall()]
-        cur.close()
+        if (len(key) == 1) and (tuple(key.items())[0] in self._key_record_ids):
+            # prefetched by prefetch_history()
+            record_ids = self._key_record_ids[tuple(key.items())[0]][:]
+        else:
+            q = ('SELECT DISTINCT `record_id` FROM {!s} '
+                 'WHERE {}'.format(
+                     self._history, ' AND '.join(
+                         ['{!s}.`{}` = {}'.format(str(self._history), k, self._db.format(v))
+                          for k, v in key.items()])))
+            cur = self._db.query(q)
+            record_ids = [x[0] for x in cur.fetchall()]
+            cur.close()
 
         # we collect records here that can be re-used for insertion
         reusables = dict([(x, []) for x in new_values])
         to_delete = []
         # get change events
         # decide fate of each record
+        # histories that were not prefetched are loaded in one go
+        all_changes = dict()
+        uncached = [x for x in record_ids
+                    if self._cached_versions(x, fields) is None]
+        if uncached:
+            all_changes = self.get_field_changes_many(fields, 'record_id',
+                                                      uncached)
         for record_id in record_ids:
-            changes = self.get_field_changes(fields,
-                                             {'record_id': record_id})
+            if record_id in all_changes: changes = all_changes[record_id]
+            else:
+                changes = self.get_field_changes(fields,
+                                                 {'record_id': record_id})
             if changes[0]['new_value'] in new_values:
                 if changes[0]['deleted'] == 0:
                     # the value is already live
@@ -518,7 +2125,7 @@ class HistoryTable(sql.Table):
                                 self._history))
                         if isinstance(fields, str):
                             self.print_update_sql(
-                                changes[0]['id'], {field: change['new_value']},
+                                changes[0]['id'], {fields: change['new_value']},
                                 manual=manual, user=user, comments=comments)
                         elif isinstance(fields, collections.abc.Iterable):
                             self.print_update_sql(
@@ -582,7 +2189,7 @@ class HistoryTable(sql.Table):
                                           comments=comments)
 
                 # don't delete this record since we re-used it
-                to_delete.remove(record_id)
+                to_delete = [x for x in to_delete if x[0] != record_id]
             else:
                 # insert new record
                 #print_insert_sql(...)
@@ -605,3 +2212,96 @@ class HistoryTable(sql.Table):
             self.print_update_sql(_id, {'deleted': 1}, manual=manual,
                                   user=user, comments=comments)
 
+    # rows of the current-state table having key_fields in keys,
+    # one query per bulk_chunk_size keys
+    # returns {key: [row1, row2, ...]}, key is the tuple of key_fields
+    def _current_rows(self, key_fields, keys):
+        first = list(collections.OrderedDict.fromkeys([x[0] for x in keys]))
+        keys = set(keys)
+        rows = dict()
+        for i in range(0, len(first), self.bulk_chunk_size):
+            q = self.select(where=sql.Column(self, key_fields[0]).in_(
+                first[i:i+self.bulk_chunk_size]))
+            cur = self._db.query(q, dictionary=True)
+            for row in cur.fetchall():
+                row = dict(row)
+                key = tuple([row[x] for x in key_fields])
+                if key in keys: rows.setdefault(key, []).append(row)
+            cur.close()
+        return rows
+
+    """
+        bring the table to a desired state with a few bulk queries instead of
+        several queries per record
+        desired_rows: iterable of dicts
+        key_fields: string or list, the fields identifying a record (or a
+            group of records, see fields)
+        fields: None: each key has one record, new keys are inserted with
+            insert_row() and existing records are updated with update_row()
+            string or list: each key has many records, the values of fields
+            of the desired rows with the same key are set with
+            update_one_to_many()
+        scope: keys (tuples of key_fields values) that are synced in the
+            one-to-many case, by default the keys of desired_rows, keys
+            without desired rows lose all their records
+        manual, user, comments: see update_row()
+        the policy on manual changes is the same as in update_row() and
+        update_one_to_many(), nothing is deleted in the one-to-one case
+    """
+    def sync_rows(self, desired_rows, key_fields, fields=None, scope=None,
+                  manual=0, user=None, comments=None):
+        if isinstance(key_fields, str): key_fields = [key_fields]
+        key_fields = list(key_fields)
+        desired = collections.OrderedDict()
+        if (fields is not None) and (scope is not None):
+            for key in scope:
+                if not isinstance(key, tuple): key = (key,)
+                desired[key] = []
+        # later rows of the same key replace earlier ones
+        for row in desired_rows:
+            key = tuple([row[x] for x in key_fields])
+            if fields is None: desired[key] = row
+            else: desired.setdefault(key, []).append(row)
+        current = self._current_rows(key_fields, list(desired.keys()))
+        logging.info('syncing {:d} keys with {:d} existing records in '
+                     '{!s}'.format(len(desired),
+                                   sum([len(x) for x in current.values()]),
+                                   self))
+        if fields is None:
+            synced = set()
+            for row in desired.values(): synced.update(row.keys())
+            record_ids = [x['record_id'] for rows in current.values()
+                          for x in rows]
+            self.prefetch_history('record_id', record_ids,
+                                  fields=sorted(synced))
+            for key, new_row in desired.items():
+                rows = current.get(key, [])
+                if len(rows) == 0:
+                    self.insert_row(new_row, manual=manual, user=user,
+                                    comments=comments)
+                    continue
+                if len(rows) > 1:
+                    logging.warning('duplicate records found for {!r} in '
+                                    '{!s}'.format(key, self))
+                for old_row in rows:
+                    self.update_row(old_row, new_row, manual=manual,
+                                    user=user, comments=comments)
+            return
+        value = ((lambda row: row[fields]) if isinstance(fields, str) else
+                 (lambda row: tuple([row[x] for x in fields])))
+        if len(key_fields) == 1:
+            # update_one_to_many() uses the prefetched records of the key
+            self.prefetch_history(key_fields[0],
+                                  [x[0] for x in desired.keys()],
+                                  fields=fields)
+        for key, rows in desired.items():
+            # unique values, in order
+            new_values = list(collections.OrderedDict(
+                [(value(x), 1) for x in rows]).keys())
+            old_values = [value(x) for x in current.get(key, [])]
+            if ((len(old_values) == len(new_values)) and
+                (set(old_values) == set(new_values))):
+                continue
+            self.update_one_to_many(fields, dict(zip(key_fields, key)),
+                                    new_values, manual=manual, user=user,
+                                    comments=comments)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import logging
+import os
+import pickle
+import sqlite3
+
+from historytable import HistoryTable
+
+# read-through cache of the current rows of a history table by a key column,
+# e.g. uniprot_proteins by accession:
+#   cache = RowCache(uniprot_proteins, 'accession')
+#   row = cache.get('P12345')                  # dict or None
+#   rows = cache.get_many(accessions)          # {accession: dict or None}
+# rows are kept in an in-process LRU of maxsize keys and, if filename is set
+# (by default the SLC_ROW_CACHE environment variable), in an SQLite file
+# shared by later runs and other scripts. both tiers remember the last
+# history id they have seen: keys with newer versions in the history table
+# are dropped from them, so only rows that changed since the last run are
+# read from the database again. for a table that reads a snapshot (see
+# HistoryTable.refresh_snapshot()), the last id is that of the snapshot's
+# latest refresh, and the keys of its snapshot_overlap ids before the last
+# id seen are dropped too. the file keeps the rows of each source table
+# (e.g. uniprot_proteins and uniprot_proteins_current) apart.
+# keys without a current row are cached as None. rows are pickled in the
+# file, so they are read back with the types of the database driver (e.g.
+# datetime for timestamps).
+class RowCache(object):
+    # PRAGMA user_version of the file, files of another format are emptied
+    file_format = 2
+
+    def __init__(self, table, key, maxsize=10000, filename=None):
+        if not isinstance(table, HistoryTable):
+            raise TypeError('RowCache needs a HistoryTable, got '
+                            '{!r}'.format(table))
+        if filename is None:
+            filename = os.environ.get('SLC_ROW_CACHE') or None
+        self.table = table
+        self.key = key
+        self.maxsize = maxsize
+        self.filename = filename
+        self._db = table._db
+        self._name = '{}.{}'.format(table._name, key)
+        # key value -> row, least recently used first
+        self._lru = collections.OrderedDict()
+        # history id up to which the tiers are up to date
+        self._last_id = None
+        self._disk = None
+        if filename is not None:
+            self._disk = sqlite3.connect(filename, timeout=60)
+            self._create_tables()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.refresh()
+
+    # drop the keys that have new history versions since the last refresh,
+    # called on creation, call it again to see changes made meanwhile
+    def refresh(self):
+        h = self.table._history
+        max_id = self.table.current_until()
+        last_id = self._last_id
+        if self._disk is not None:
+            disk_last_id = self._disk_last_id()
+            # without a state, nothing of this table is cached in the file
+            if ((disk_last_id is not None) and
+                ((last_id is None) or (disk_last_id < last_id))):
+                last_id = disk_last_id
+        if last_id is None: last_id = max_id
+        if max_id < last_id:
+            # the history table has been rebuilt or compacted away
+            logging.info('history {!s} is older than row cache, dropping '
+                         'it'.format(h))
+            self._invalidate(None)
+        elif max_id > last_id:
+            # the refresh of a snapshot also replaces records with versions
+            # committed late, see HistoryTable.refresh_snapshot()
+            since = last_id
+            if self.table._reads_snapshot:
+                since = max(last_id - self.table.snapshot_overlap, 0)
+            # all keys of the changed records, the key may have changed
+            cur = self._db.query('SELECT DISTINCT `{key}` FROM {h} '
+                                 'WHERE `record_id` IN ('
+                                 'SELECT `record_id` FROM {h} '
+                                 'WHERE `id` > %s AND `id` <= %s);'.format(
+                                     key=self.key, h=h), since, max_id)
+            changed = [x[0] for x in cur.fetchall()]
+            cur.close()
+            logging.debug('{:d} keys of {!s} changed since history id '
+                          '{:d}'.format(len(changed), h, last_id))
+            self._invalidate(changed)
+        self._last_id = max_id
+        if self._disk is not None:
+            self._disk.execute('REPLACE INTO row_cache_state (name, last_id) '
+                               'VALUES (?, ?)', (self._name, max_id))
+            self._disk.commit()
+
+    def _create_tables(self):
+        self._disk.execute('BEGIN IMMEDIATE')
+        try:
+            version = self._disk.execute('PRAGMA user_version').fetchone()[0]
+            if version != self.file_format:
+                # e.g. rows stored as JSON by earlier versions
+                self._disk.execute('DROP TABLE IF EXISTS row_cache_state')
+                self._disk.execute('DROP TABLE IF EXISTS row_cache')
+                self._disk.execute('PRAGMA user_version = {:d}'.format(
+                    self.file_format))
+            self._disk.execute('CREATE TABLE IF NOT EXISTS row_cache_state ('
+                               'name TEXT PRIMARY KEY, last_id INTEGER)')
+            self._disk.execute('CREATE TABLE IF NOT EXISTS row_cache ('
+                               'name TEXT, key TEXT, id INTEGER, row BLOB, '
+                               'PRIMARY KEY (name, key))')
+            self._disk.commit()
+        except Exception:
+            self._disk.rollback()
+            raise
+
+    def _disk_last_id(self):
+        row = self._disk.execute('SELECT last_id FROM row_cache_state '
+                                 'WHERE name = ?', (self._name,)).fetchone()
+        return None if row is None else row[0]
+
+    # keys: key values to drop, None drops everything
+    def _invalidate(self, keys):
+        if keys is None:
+            self._lru.clear()
+            if self._disk is not None:
+                self._disk.execute('DELETE FROM row_cache WHERE name = ?',
+                                   (self._name,))
+            return
+        for key in keys:
+            self._lru.pop(key, None)
+        if self._disk is not None:
+            self._disk.executemany(
+                'DELETE FROM row_cache WHERE name = ? AND key = ?',
+                [(self._name, json.dumps(x)) for x in keys])
+
+    def _remember(self, key, row):
+        self._lru[key] = row
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    # the current row of key as dict, or None if there is none
+    def get(self, key):
+        return self.get_many([key])[key]
+
+    # {key: row or None} for all keys, the rows missing in both tiers are
+    # read with one query per bulk_chunk_size keys of the table
+    def get_many(self, keys):
+        rows = dict()
+        missing = []
+        for key in keys:
+            if key in rows: continue
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                rows[key] = self._lru[key]
+                self.hits += 1
+            else:
+                missing.append(key)
+        if missing and (self._disk is not None):
+            still_missing = []
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i+500]
+                found = dict(self._disk.execute(
+                    'SELECT key, row FROM row_cache WHERE name = ? AND key IN '
+                    '({})'.format(', '.join(['?']*len(chunk))),
+                    [self._name] + [json.dumps(x) for x in chunk]).fetchall())
+                for key in chunk:
+                    if json.dumps(key) in found:
+                        rows[key] = pickle.loads(found[json.dumps(key)])
+                        self._remember(key, rows[key])
+                        self.disk_hits += 1
+                    else:
+                        still_missing.append(key)
+            missing = still_missing
+        if missing:
+            self.misses += len(missing)
+            fetched = self._fetch(missing)
+            for key in missing:
+                rows[key] = fetched.get(key)
+                self._remember(key, rows[key])
+            if self._disk is not None: self._store(missing, rows)
+        return rows
+
+    # write fetched rows to the file, unless another process has refreshed
+    # it meanwhile: its invalidations may be newer than the rows
+    def _store(self, keys, rows):
+        self._disk.execute('BEGIN IMMEDIATE')
+        try:
+            if self._disk_last_id() == self._last_id:
+                self._disk.executemany(
+                    'REPLACE INTO row_cache (name, key, id, row) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(self._name, json.dumps(key),
+                      None if rows[key] is None else rows[key].get('id'),
+                      pickle.dumps(rows[key], pickle.HIGHEST_PROTOCOL))
+                     for key in keys])
+            self._disk.commit()
+        except Exception:
+            self._disk.rollback()
+            raise
+
+    def _fetch(self, keys):
+        t = self.table
+        chunk_size = t.bulk_chunk_size
+        fetched = dict()
+        for i in range(0, len(keys), chunk_size):
+            q = t.select(where=getattr(t, self.key).in_(keys[i:i+chunk_size]))
+            cur = self._db.query(q, dictionary=True)
+            for row in cur.fetchall():
+                fetched[row[self.key]] = dict(row)
+            cur.close()
+        return fetched
+
+    def close(self):
+        logging.info('row cache {}: {:d} hits, {:d} disk hits, {:d} '
+                     'misses'.format(self._name, self.hits, self.disk_hits,
+                                     self.misses))
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import collections
+import multiprocessing
+import os
+
+from fastaindex import AccessionIndex
+
+# parser of UniProt flat files (uniprot_sprot.dat, uniprot_trembl.dat, ...):
+#   for entry in parse_entries(f):
+#       entry['accessions'] ...
+# or, to parse only the entries of some accessions from a binary stream:
+#   for entry in scan_entries(f, accessions):
+# or to read them from a BGZF file through an index, see UniProtIndex
+# an entry is a dict with
+#   uniprot_id: the name of the ID line
+#   reviewed: True for Swiss-Prot entries
+#   accessions: [accession1, accession2, ...] of the AC lines
+#   name: the first full RecName or SubName of the DE lines, with
+#       ' (Fragment)' appended for fragments
+#   symbol: the Name of the GN lines
+#   tax_id: the NCBI_TaxID of the OX line (int)
+#   annots: [(db, xref), ...] of the DR lines of the databases in
+#       DBREF_TYPES, without duplicates
+
+# DR lines kept in annots
+DBREF_TYPES = ('HGNC', 'GeneID', 'UniGene', 'FlyBase', 'KEGG')
+_dr_prefixes = tuple(['DR   {};'.format(x) for x in DBREF_TYPES])
+# line codes parse_lines() looks at
+_line_codes = frozenset(['ID', 'AC', 'DE', 'GN', 'OX', 'DR', '//'])
+
+def _new_entry():
+    return {'uniprot_id': None, 'reviewed': None, 'accessions': [],
+            'name': None, 'fragment': False, 'symbol': None,
+            'tax_id': None, 'annots': []}
+
+def _finish_entry(entry):
+    if entry['fragment'] and (entry['name'] is not None):
+        entry['name'] = entry['name'] + ' (Fragment)'
+    del entry['fragment']
+    # remove duplicates
+    entry['annots'] = list(collections.OrderedDict.fromkeys(entry['annots']))
+    return entry
+
+# parse the lines of entries, returns the list of entries
+def parse_lines(lines):
+    entries = []
+    entry = _new_entry()
+    for line in lines:
+        # most lines (CC, FT, sequence, ...) are skipped here
+        if line[:2] not in _line_codes: continue
+        if line.startswith('ID   '):
+            entry['uniprot_id'] = line.strip().split()[1].rstrip(';')
+            entry['reviewed'] = (line.strip().split()[2] == 'Reviewed;')
+        elif line.startswith('AC   '):
+            for acc in line.strip().split()[1:]:
+                acc = acc.rstrip(';')
+                if acc not in entry['accessions']:
+                    entry['accessions'].append(acc)
+        elif ((line.startswith('DE   RecName: Full=') or
+               line.startswith('DE   SubName: Full=')) and
+              (entry['name'] is None)):
+            entry['name'] = line.strip().split('=')[1].rstrip(';')\
+                    .split('{')[0].strip()
+        elif line.startswith('DE   Flags: Fragment;'):
+            entry['fragment'] = True
+        elif line.startswith('GN   Name='):
+            entry['symbol'] = line.strip().split()[1].split('=')[1].rstrip(';')
+        elif line.startswith('OX   NCBI_TaxID='):
+            entry['tax_id'] = int(line.strip().split()[1].split('=')[1]
+                                  .rstrip(';'))
+        elif line.startswith(_dr_prefixes):
+            entry['annots'].append((line[5:].split(';')[0],
+                                    line.strip().split(';')[1].strip()))
+        elif line.startswith('//'):
+            entries.append(_finish_entry(entry))
+            entry = _new_entry()
+    return entries
+
+def parse_block(block):
+    return parse_lines(block.splitlines())
+
+# (start, end) of the entries of a block of bytes, each ending after its //
+# line (or at the end of the block)
+def _entry_spans(block):
+    start = 0
+    while start < len(block):
+        end = block.find(b'\n//', start)
+        if end >= 0: end = block.find(b'\n', end+1)
+        if end < 0: end = len(block)
+        else: end += 1
+        yield start, end
+        start = end
+
+# the accessions (bytes) of the AC lines of the entry at start:end of block,
+# the AC lines follow the ID line
+def _entry_accessions(block, start, end):
+    ac = block.find(b'\nAC   ', start, end)
+    while ac >= 0:
+        eol = block.find(b'\n', ac+1, end)
+        if eol < 0: eol = end
+        for x in block[ac+6:eol].split(b';'):
+            x = x.strip()
+            if x: yield x
+        ac = eol if block.startswith(b'\nAC   ', eol) else -1
+
+# the entries of a block of bytes that have one of accessions (a set of
+# bytes) in their AC lines, only these are decoded and parsed
+def scan_block(block, accessions):
+    entries = []
+    for start, end in _entry_spans(block):
+        if any(x in accessions for x in _entry_accessions(block, start, end)):
+            entries.extend(parse_lines(
+                block[start:end].decode('utf-8').splitlines()))
+    return entries
+
+# (accession, offset, length) of every accession of the entries of a binary
+# stream, for UniProtIndex
+def entry_records(f):
+    offset = 0
+    for block in entry_blocks(f):
+        for start, end in _entry_spans(block):
+            seen = set()
+            for acc in _entry_accessions(block, start, end):
+                if acc in seen: continue
+                seen.add(acc)
+                yield (acc, offset+start, end-start)
+        offset += len(block)
+
+# split a text (or binary) stream into blocks of about block_size characters
+# (or bytes) that end with the // line of an entry
+def entry_blocks(f, block_size=1 << 22):
+    rest = None
+    nl, sep = '\n', '\n//'
+    while True:
+        data = f.read(block_size)
+        if rest is None:
+            rest = data[:0]
+            if isinstance(data, bytes): nl, sep = b'\n', b'\n//'
+        if not data:
+            if rest: yield rest
+            return
+        data = rest + data
+        end = data.rfind(sep)
+        # the // line needs to be complete
+        while end >= 0:
+            eol = data.find(nl, end+1)
+            if eol >= 0:
+                end = eol+1
+                break
+            end = data.rfind(sep, 0, end)
+        if end < 0:
+            rest = data
+            continue
+        yield data[:end]
+        rest = data[end:]
+
+# the start method of the worker processes: fork, so the scripts don't need
+# a __main__ guard
+def _context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+# parse the entries of a text stream in processes worker processes (by
+# default the SLC_UNIPROT_PROCESSES environment variable or the number of
+# cores), yields the entries in the order of the stream
+def parse_entries(f, processes=None, block_size=1 << 22):
+    yield from _map_blocks(f, parse_block, (), processes, block_size)
+
+# like parse_entries(), but only for the entries with any of accessions in
+# their AC lines, f is a binary stream
+# the other entries are skipped without decoding them, only their AC lines
+# are looked at
+def scan_entries(f, accessions, processes=None, block_size=1 << 22):
+    accessions = frozenset([x.encode('utf-8') for x in accessions])
+    yield from _map_blocks(f, scan_block, (accessions,), processes,
+                           block_size)
+
+# yields the entries returned by func(block, *args) for the blocks of f in
+# order, at most 2*processes blocks are read ahead, so memory stays bounded
+# the pool is forked before f is read, so the decompression thread of a
+# stream of gzstream.open_gz() isn't running yet
+def _map_blocks(f, func, args, processes, block_size):
+    if processes is None:
+        processes = int(os.environ.get('SLC_UNIPROT_PROCESSES') or
+                        os.cpu_count() or 1)
+    if processes <= 1:
+        for block in entry_blocks(f, block_size):
+            yield from func(block, *args)
+        return
+    with _context().Pool(processes) as pool:
+        pending = collections.deque()
+        for block in entry_blocks(f, block_size):
+            pending.append(pool.apply_async(func, (block,) + args))
+            if len(pending) >= 2*processes:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+# index of the entries of a UniProt flat file by accession (secondary
+# accessions too), only useful for BGZF files (see pylib/bgzf.py and
+# bgzip-uniprot.py), as an uncompressed file can be scanned just as well:
+#   index = UniProtIndex('uniprot_sprot.txt.bgz')
+#   for entry in index.entries(accessions):
+# the index is kept in <filename>.accidx, see AccessionIndex
+class UniProtIndex(AccessionIndex):
+    def _records(self, f):
+        return entry_records(f)
+
+    # the entry of accession, or None
+    def get(self, accession):
+        record = self.get_bytes(accession)
+        if record is None: return None
+        return parse_block(record.decode('utf-8'))[0]
+
+    # the entries with any of accessions, each once, in the order of the file
+    def entries(self, accessions):
+        locations = set()
+        for acc in accessions:
+            location = self.locate(acc)
+            if location is not None: locations.add(location)
+        for location in sorted(locations):
+            yield from parse_block(self._read(*location).decode('utf-8'))
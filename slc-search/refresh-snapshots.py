@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# vim: ai
+
+# brings the snapshot tables (<name>_current) read by the clustering scripts
+# up to date, see HistoryTable.refresh_snapshot(). the snapshots are written
+# directly, so this needs write access to the database
+#
+#   python refresh-snapshots.py [--full] [table1 table2 ...]
+#
+# --full: rebuild the snapshots from scratch, e.g. after the structure of a
+# history table has changed
+
+import sys
+import logging
+
+sys.path.append('./pylib')
+
+from historytable import open_database, HistoryTable
+
+#logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
+DB = open_database()
+
+tables = sys.argv[1:]
+full = '--full' in tables
+if full: tables.remove('--full')
+if not tables:
+    tables = ['uniprot_proteins', 'uniprot_dbrefs', 'slc_like']
+
+for table in tables:
+    HistoryTable(table, DB, snapshot=True).refresh_snapshot(full=full)
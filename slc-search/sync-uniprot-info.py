@@ -8,12 +8,13 @@ import sys
 sys.path.append('./pylib')
 
 import glob
-import gzip
 import collections
-import itertools
 import os.path
 
-from historytable import Database, HistoryTable
+from historytable import open_database, HistoryTable
+from uniprot import scan_entries, UniProtIndex
+from fastaindex import FastaIndex
+from gzstream import open_gz
 
 user = 'sync-uniprot-info.py'
 
@@ -25,7 +26,7 @@ user = 'sync-uniprot-info.py'
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 hmm_hits = sql.Table('hmm_hits')
 
@@ -61,6 +62,14 @@ for fn in uniprot_fns:
 comments2 = comments1[:]
 comments2[0] = 'Updated based on slc_like with status > 0.'
 
+# the desired state of uniprot_proteins and uniprot_dbrefs is collected first
+# and synced at the end with a few bulk queries, separately for accessions
+# with comments1 and comments2
+#   comments -> [row1, row2, ...]
+desired_proteins = {1: [], 2: []}
+#   comments -> {accession: [(db, xref), ...]}
+desired_dbrefs = {1: dict(), 2: dict()}
+
 def fasta_records(f):
     record = None
     for line in f:
@@ -75,120 +84,102 @@ def fasta_records(f):
         record.append(line)
     if record: yield record
 
-fasta_store = dict()
+# the FASTA files in the order they were given, each with a get(accession)
+# method returning the record (header and sequence lines) or None
+fasta_sources = []
+
+# the FASTA record of an accession of all_accessions, from the first FASTA
+# file that has it, or None
+def fasta_record(acc):
+    if acc not in all_accessions: return None
+    for source in fasta_sources:
+        record = source.get(acc)
+        if record is not None: return record
+    return None
+
+# collect the desired rows of an entry for its accessions in wanted
+def add_entry(entry, wanted):
+    for acc in set(entry['accessions']) & wanted:
+        seq_fasta = fasta_record(acc)
+        if seq_fasta is None:
+            logging.warning('accession {} has no associated fasta '
+                            'sequence, skipping'.format(acc))
+            continue
+
+        new_row = {
+            'tax_id': entry['tax_id'],
+            'accession': acc,
+            'uniprot_id': entry['uniprot_id'],
+            'name': entry['name'],
+            'symbol': entry['symbol'],
+            'seq_fasta': seq_fasta,
+            'reviewed': int(entry['reviewed'])}
+
+        if acc in all_accessions: comments = 1
+        if acc in all_slc_like_accessions: comments = 2
+        desired_proteins[comments].append(new_row)
+        desired_dbrefs[comments][acc] = entry['annots']
+
+wanted = all_accessions | all_slc_like_accessions
 
 # set everything to accepted
 for uniprot_fn in uniprot_fns:
+    if uniprot_fn.endswith('.fasta') or uniprot_fn.endswith('.fasta.bgz'):
+        # records are read on demand through an index by accession, which
+        # is built on first use, see pylib/fastaindex.py
+        fasta_sources.append(FastaIndex(uniprot_fn))
+        continue
+    if uniprot_fn.endswith('.txt.bgz'):
+        # BGZF files (see bgzip-uniprot.py): only the blocks of the wanted
+        # entries are read and decompressed, through an index by accession
+        index = UniProtIndex(uniprot_fn)
+        for entry in index.entries(wanted):
+            add_entry(entry, wanted)
+        index.close()
+        continue
+
+    # TXT files are scanned as bytes, see below
+    binary = uniprot_fn.endswith('.txt') or uniprot_fn.endswith('.txt.gz')
     if uniprot_fn.endswith('.gz'):
-        f = gzip.open(uniprot_fn, 'rt', encoding='utf-8')
+        # decompressed in another thread or process, see pylib/gzstream.py
+        if binary: f = open_gz(uniprot_fn, 'rb')
+        else: f = open_gz(uniprot_fn, 'rt', encoding='utf-8')
     else:
-        f = open(uniprot_fn, 'rt', encoding='utf-8')
-
-    if uniprot_fn.endswith('.fasta') or uniprot_fn.endswith('.fasta.gz'):
-        for fasta_record in fasta_records(f):
-            accession = fasta_record[0].split()[0].split('|')[1]
+        if binary: f = open(uniprot_fn, 'rb')
+        else: f = open(uniprot_fn, 'rt', encoding='utf-8')
+
+    if uniprot_fn.endswith('.fasta.gz'):
+        # gzipped files can't be read at an offset, the records of
+        # all_accessions are kept in memory
+        fasta_store = dict()
+        for record in fasta_records(f):
+            accession = record[0].split()[0].split('|')[1]
             if ((accession in all_accessions) and 
                 (accession not in fasta_store)):
-                fasta_store[accession] = fasta_record
+                fasta_store[accession] = ''.join(record)
+        fasta_sources.append(fasta_store)
     elif uniprot_fn.endswith('.txt') or uniprot_fn.endswith('.txt.gz'):
-        uniprot_id = None
-        reviewed = None
-        name = None
-        symbol = None
-        tax_id = None
-        fragment = False
-        accessions = set()
-        annots = []
-        for line in f:
-            if line.startswith('ID   '):
-                uniprot_id = line.strip().split()[1].rstrip(';')
-                reviewed = (line.strip().split()[2] == 'Reviewed;')
-            elif line.startswith('AC   '):
-                for acc in line.strip().split()[1:]:
-                    accessions.add(acc.rstrip(';'))
-            elif ((line.startswith('DE   RecName: Full=') or
-                   line.startswith('DE   SubName: Full=')) and (name is None)):
-                name = line.strip().split('=')[1].rstrip(';')\
-                        .split('{')[0].strip()
-            elif line.startswith('DE   Flags: Fragment;'):
-                fragment = True
-            elif line.startswith('GN   Name='):
-                symbol = line.strip().split()[1].split('=')[1].rstrip(';')
-            elif line.startswith('OX   NCBI_TaxID='):
-                tax_id = int(line.strip().split()[1].split('=')[1].rstrip(';'))
-            elif line.startswith("DR   HGNC;"):
-                annots.append( ("HGNC", line.strip().split(";")[1].strip()) )
-            elif line.startswith("DR   GeneID;"):
-                annots.append( ("GeneID", line.strip().split(";")[1].strip()) )
-            elif line.startswith("DR   UniGene;"):
-                annots.append( ("UniGene", line.strip().split(";")[1].strip()) )
-            elif line.startswith("DR   FlyBase;"):
-                annots.append( ("FlyBase", line.strip().split(";")[1].strip()) )
-            elif line.startswith("DR   KEGG;"):
-                annots.append( ("KEGG", line.strip().split(";")[1].strip()) )
-            elif line.startswith('//'):
-                if fragment and (name is not None): name = name + ' (Fragment)'
-                for acc in accessions & (all_accessions |
-                                         all_slc_like_accessions):
-                    # check GN, OX and ID fields...
-                    q = uniprot_proteins.select(
-                        where=(uniprot_proteins.accession == acc))
-                    cur = DB.query(q, dictionary=True)
-                    rows = cur.fetchall()
-                    cur.close()
-
-                    if acc not in fasta_store:
-                        logging.warning('accession {} has no associated fasta '
-                                        'sequence, skipping'.format(acc))
-                        continue
-
-                    new_row = {
-                        'tax_id': tax_id,
-                        'accession': acc,
-                        'uniprot_id': uniprot_id,
-                        'name': name,
-                        'symbol': symbol,
-                        'seq_fasta': ''.join(fasta_store[acc]),
-                        'reviewed': int(reviewed)}
-
-                    if acc in all_accessions: comments = comments1
-                    if acc in all_slc_like_accessions: comments = comments2
-                    if len(rows) == 0:
-                        uniprot_proteins.insert_row(new_row, manual=0,
-                                                    user=user,
-                                                    comments=comments)
-                    else:
-                        if len(rows) > 1:
-                            logging.warning('duplicate records found for '
-                                            '{}'.format(acc))
-                        for old_row in rows:
-                            uniprot_proteins.update_row(
-                                old_row, new_row, manual=0, user=user,
-                                comments=comments)
-
-                    # remove duplicates
-                    annots = list(dict(zip(annots, itertools.repeat(1))).keys())
-
-                    q = uniprot_dbrefs.select(
-                        uniprot_dbrefs.db,
-                        uniprot_dbrefs.xref,
-                        where=(uniprot_dbrefs.accession == acc))
-                    cur = DB.query(q)
-                    old_annots = [tuple(x) for x in cur.fetchall()]
-                    if old_annots != annots:
-                        uniprot_dbrefs.update_one_to_many(('db', 'xref'),
-                                                          {'accession': acc},
-                                                          annots, manual=0,
-                                                          user=user,
-                                                          comments=comments)
-
-                uniprot_id = None
-                reviewed = None
-                name = None
-                symbol = None
-                tax_id = None
-                fragment = False
-                accessions = set()
-                annots = []
+        # only the entries of wanted accessions are parsed (in worker
+        # processes), the AC lines of the others are checked as bytes, see
+        # pylib/uniprot.py
+        for entry in scan_entries(f, wanted):
+            add_entry(entry, wanted)
     f.close()
 
+for source in fasta_sources:
+    if isinstance(source, FastaIndex): source.close()
+
+for comments, c in ((1, comments1), (2, comments2)):
+    # check GN, OX and ID fields...
+    uniprot_proteins.sync_rows(desired_proteins[comments], 'accession',
+                               manual=0, user=user, comments=c)
+    uniprot_dbrefs.sync_rows(
+        [{'accession': acc, 'db': db, 'xref': xref}
+         for acc, annots in desired_dbrefs[comments].items()
+         for db, xref in annots],
+        'accession', fields=('db', 'xref'),
+        scope=desired_dbrefs[comments].keys(), manual=0, user=user,
+        comments=c)
+
+# apply queued writes (direct mode only)
+DB.flush()
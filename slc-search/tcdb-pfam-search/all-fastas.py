@@ -9,20 +9,16 @@ import sys
 
 sys.path.append('../pylib')
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, HistoryTable, Table
 
 logging.basicConfig(level=logging.DEBUG)
 
-DB = Database()
+DB = open_database()
 
 tcdb_sequences = sql.Table('tcdb_sequences')
 
 q = tcdb_sequences.select()
-cur = DB.query(q, dictionary=True)
-all_selected_sequences = cur.fetchall()
-cur.close()
-
-for seq in all_selected_sequences:
+for seq in DB.iterate(q, dictionary=True):
     if seq['seq_fasta'] is None:
         logging.warning('{} / {} -> no sequence'.format(seq['tcdb_id'], seq['accession']))
         continue
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: ai
+
+# tests of pylib/historytable.py on an in-memory SQLite database
+#
+#   python -m pytest tests
+
+import os
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'pylib'))
+
+from historytable import SQLiteDatabase, HistoryTable, QueryProfiler
+
+SCHEMA = '''
+CREATE TABLE `proteins_history` (
+    `id` INTEGER PRIMARY KEY,
+    `record_id` INT,
+    `manual` INT DEFAULT 0,
+    `deleted` INT DEFAULT 0,
+    `timestamp` TEXT DEFAULT CURRENT_TIMESTAMP,
+    `user` TEXT,
+    `comments` TEXT,
+    `accession` TEXT,
+    `name` TEXT);
+CREATE VIEW `proteins` AS SELECT * FROM `proteins_history`
+    WHERE `id` IN (SELECT MAX(`id`) FROM `proteins_history`
+                   GROUP BY `record_id`) AND `deleted` = 0;
+'''
+
+def open_test_database():
+    db = SQLiteDatabase(':memory:', direct=True)
+    db.conn.executescript(SCHEMA)
+    db.conn.commit()
+    return db
+
+# an update of a row written long ago must not keep its old timestamp,
+# otherwise as_of() at a point between the two versions finds the new one
+def test_update_gets_new_timestamp():
+    db = open_test_database()
+    db.conn.execute('INSERT INTO `proteins_history` (`id`, `record_id`, '
+                    '`timestamp`, `accession`, `name`) '
+                    'VALUES (1, 1, \'2020-01-01 00:00:00\', \'P1\', \'old\');')
+    db.conn.commit()
+    proteins = HistoryTable('proteins', db)
+    proteins.print_update_sql(1, {'name': 'new'}, user='test')
+    db.flush()
+
+    rows = db.conn.execute('SELECT `id`, `timestamp`, `name` '
+                           'FROM `proteins_history` ORDER BY `id`;').fetchall()
+    assert len(rows) == 2
+    assert rows[1][2] == 'new'
+    assert rows[1][1] != '2020-01-01 00:00:00'
+
+    cur = db.query(proteins.as_of('2020-06-01 00:00:00'), dictionary=True)
+    assert [x['name'] for x in cur.fetchall()] == ['old']
+    cur = db.query(proteins.as_of(2), dictionary=True)
+    assert [x['name'] for x in cur.fetchall()] == ['new']
+
+# the archived versions are copied and deleted in one transaction
+def test_compact_archives_and_deletes_together(capsys):
+    db = open_test_database()
+    for i in range(1, 5):
+        db.conn.execute('INSERT INTO `proteins_history` (`id`, `record_id`, '
+                        '`accession`, `name`) VALUES (?, 1, ?, ?);',
+                        (i, 'P{:d}'.format(i), 'v{:d}'.format(i)))
+    db.conn.commit()
+    db.direct = False
+    proteins = HistoryTable('proteins', db)
+    assert proteins.print_compact_sql(100) == 2
+    lines = capsys.readouterr().out.splitlines()
+    i = lines.index('BEGIN;')
+    assert lines[i+1].startswith('INSERT INTO "proteins_history_archive"')
+    assert lines[i+1].endswith('IN (1, 2);')
+    assert lines[i+2] == ('DELETE FROM "proteins_history" '
+                          'WHERE `id` IN (1, 2);')
+    assert lines[i+3] == 'COMMIT;'
+
+# combined INSERT statements stay below max_allowed_packet in bytes, also
+# with multi-byte characters
+def test_combined_insert_size_in_bytes(capsys):
+    db = SQLiteDatabase(':memory:', max_allowed_packet=200)
+    for i in range(20):
+        db.write_insert('`t`', ['`name`'], '(%s)', ['äöü'*5])
+    db.flush()
+    statements = capsys.readouterr().out.split(';\n')
+    assert len(statements) > 2
+    assert max([len((x+';').encode('utf-8')) for x in statements]) <= 200
+
+# queries recorded by several threads at once are all counted
+def test_profiler_counts_concurrent_queries():
+    profiler = QueryProfiler()
+    def run():
+        for i in range(2000):
+            cur = profiler.executed(None, 'SELECT {:d};'.format(i), 0.001)
+            cur._fetched(0.0, 1)
+    threads = [threading.Thread(target=run) for i in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert list(profiler.stats.keys()) == ['SELECT ?;']
+    entry = profiler.stats['SELECT ?;']
+    assert entry['count'] == 16000
+    assert entry['rows'] == 16000
+    profiler.stats.clear()
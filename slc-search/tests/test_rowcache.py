@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# vim: ai
+
+# tests of pylib/rowcache.py on an in-memory SQLite database
+#
+#   python -m pytest tests
+
+import datetime
+import decimal
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'pylib'))
+
+from historytable import HistoryTable
+from rowcache import RowCache
+from test_historytable import open_test_database
+
+# rows read from the file keep the types the database driver returned
+def test_file_keeps_types(tmp_path):
+    db = open_test_database()
+    db.conn.execute('INSERT INTO `proteins_history` (`id`, `record_id`, '
+                    '`accession`, `name`) VALUES (1, 1, \'P1\', \'a\');')
+    db.conn.commit()
+    proteins = HistoryTable('proteins', db)
+    filename = str(tmp_path / 'rows.cache')
+    row = {'id': 1, 'accession': 'P1',
+           'timestamp': datetime.datetime(2020, 1, 1, 12, 0),
+           'score': decimal.Decimal('1.50'), 'seq': b'MKV'}
+
+    cache = RowCache(proteins, 'accession', filename=filename)
+    # as mysql.connector would return it
+    cache._fetch = lambda keys: {'P1': dict(row)}
+    assert cache.get('P1') == row
+    cache.close()
+
+    cache = RowCache(proteins, 'accession', filename=filename)
+    cache._fetch = lambda keys: {}
+    assert cache.get('P1') == row
+    assert cache.disk_hits == 1
+    cache.close()
+
+# a sync writes new versions, a script caches rows of the stale snapshot,
+# then refresh-snapshots.py runs: later runs read the new rows, through the
+# snapshot and through the current-state view
+def test_snapshot_rows_refreshed(tmp_path):
+    db = open_test_database()
+    db.conn.execute('INSERT INTO `proteins_history` (`id`, `record_id`, '
+                    '`accession`, `name`) VALUES (1, 1, \'P1\', \'old\');')
+    db.conn.commit()
+    HistoryTable('proteins', db, snapshot=True).refresh_snapshot()
+    filename = str(tmp_path / 'rows.cache')
+
+    # sync
+    db.conn.execute('INSERT INTO `proteins_history` (`id`, `record_id`, '
+                    '`accession`, `name`) VALUES (2, 1, \'P1\', \'new\');')
+    db.conn.commit()
+
+    # clustering before the refresh sees the snapshot as it is
+    cache = RowCache(HistoryTable('proteins', db, snapshot=True), 'accession',
+                     filename=filename)
+    assert cache.get('P1')['name'] == 'old'
+    cache.close()
+
+    HistoryTable('proteins', db, snapshot=True).refresh_snapshot()
+
+    cache = RowCache(HistoryTable('proteins', db, snapshot=True), 'accession',
+                     filename=filename)
+    assert cache.get('P1')['name'] == 'new'
+    cache.close()
+    cache = RowCache(HistoryTable('proteins', db), 'accession',
+                     filename=filename)
+    assert cache.get('P1')['name'] == 'new'
+    cache.close()
@@ -5,20 +5,21 @@ import glob
 import sys
 import gzip
 import logging
+import time
 
 import sql
 import sql.aggregate
 
 sys.path.append('./pylib')
 
-from historytable import Database, HistoryTable, Table
+from historytable import open_database, Database, HistoryTable, Table
 
 user = 'upload-hmm-hits.py'
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 
-DB = Database()
+DB = open_database()
 
 hmm_hits = Table('hmm_hits', DB)
 
@@ -90,7 +91,8 @@ comments.append('Based on HMM search on set of UniProt sequences, unfiltered, '
 #else: record_id += 1
 #cur.close()
 
-print('TRUNCATE TABLE {!s};'.format(hmm_hits))
+start = time.time()
+hmm_hits.print_truncate_sql()
 for key, hit in hits.items():
     pfam_id, uniprot_acc = key
     pfam_name = pfam_names[pfam_id]
@@ -140,3 +142,10 @@ for key, hit in hits.items():
               Database.format(user), Database.format('\n'.join(comments))))
     record_id += 1
     """
+
+# apply queued writes (direct mode only)
+DB.flush()
+elapsed = time.time() - start
+logging.info('{} {:d} rows in {:.1f} s ({:.0f} rows/s)'.format(
+    'uploaded' if DB.direct else 'wrote SQL for', len(hits), elapsed,
+    len(hits)/elapsed if elapsed > 0 else 0.0))